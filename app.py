@@ -1,11 +1,29 @@
 import streamlit as st
 import pandas as pd
 import math
+import numpy as np
 import io
 import zipfile
 import os
+import sys
+import time
+import copy
+import json
+import pickle
+import hashlib
+import threading
+import openpyxl
+import xlsxwriter
 from PIL import Image, ImageDraw, ImageFont
-from datetime import datetime, timedelta
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from payroll_engine import (
+    PUNCH_COLUMNS, normalize_employee_name, build_employee_master, register_employee_names, lookup_employee_id,
+    attach_employee_ids, employee_mismatch_report, DEFAULT_COMPILED_SHIFT_RULES, load_shift_rules,
+    partition_by_employee, order_like_roster, calculate_payroll_hours, calculate_payroll_hours_parallel
+)
 
 # ==========================================
 # 會計級精算引擎
@@ -16,6 +34,25 @@ def custom_round(n):
 def custom_round_2(n):
     return math.floor(n * 100 + 0.5) / 100.0
 
+# 整數分定點運算：金額以「分」為單位，時數與倍數以萬分之一為單位，全程整數除法，杜絕浮點誤差翻動一分錢
+MONEY_QTY_SCALE = 10000
+
+def _scale_half_up(values, scale):
+    # 以十進位字串四捨五入 (非 np.rint 的銀行家捨入，也不受 0.145 * 100 = 14.4999... 影響)：0.125 元 → 13 分
+    arr = np.asarray(values, dtype=float)
+    units = [int((Decimal(str(v)) * scale).to_integral_value(ROUND_HALF_UP)) for v in arr.ravel().tolist()]
+    return np.array(units, dtype=object).reshape(arr.shape)
+
+def to_cents(values):
+    return _scale_half_up(values, 100)
+
+def to_qty_units(values):
+    return _scale_half_up(values, MONEY_QTY_SCALE)
+
+def half_up_div(num, den):
+    # 等同 math.floor(num / den + 0.5)，以 Python 整數運算避免溢位
+    return (2 * num + den) // (2 * den)
+
 def fmt(val):
     s = f"{val:,.2f}"
     if s.endswith(".00"):
@@ -24,43 +61,28 @@ def fmt(val):
         return s[:-1]
     return s
 
-def snap_punch_time(dt, is_in):
-    if is_in:
-        if dt.minute == 0 and dt.second == 0:
-            return dt
-        elif dt.minute < 30 or (dt.minute == 30 and dt.second == 0):
-            return dt.replace(minute=30, second=0, microsecond=0)
-        else:
-            return (dt + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
-    else:
-        if dt.minute < 30:
-            return dt.replace(minute=0, second=0, microsecond=0)
-        else:
-            return dt.replace(minute=30, second=0, microsecond=0)
-
 # ==========================================
 # 模組一：打卡紀錄清洗
 # ==========================================
-def clean_ichef_data(file):
-    cleaned_data = []
-    error_log = []
-    raw_data = pd.read_excel(file, header=None)
+ICHEF_SYSTEM_KEYWORDS = ["上班", "下班", "無下班", "無上班", "無下班記錄", "無上班記錄", "無下班紀錄", "無上班紀錄", "結帳收銀", "admin", "nan", "總時數：0:00:00"]
+
+def iter_ichef_records(rows):
+    """逐列消化 iCHEF 匯出內容，依序產出 ("session", 打卡段) 或 ("error", 異常紀錄)。"""
     current_employee = ""
     current_clock_in = None
 
-    for index, row in raw_data.iterrows():
+    for row in rows:
         action = str(row[0]).strip()
         time_record = str(row[1]).strip()
-        system_keywords = ["上班", "下班", "無下班", "無上班", "無下班記錄", "無上班記錄", "無下班紀錄", "無上班紀錄", "結帳收銀", "admin", "nan", "總時數：0:00:00"]
 
         is_employee = True
-        if action in system_keywords or "總時數" in action:
+        if action in ICHEF_SYSTEM_KEYWORDS or "總時數" in action:
             is_employee = False
             
         if is_employee and action != "":
             if current_clock_in is not None:
-                error_log.append({"員工": current_employee, "異常類型": "換人前無下班紀錄", "打卡時間": current_clock_in})
-                cleaned_data.append({"員工": current_employee, "上班時間": current_clock_in, "下班時間": pd.NaT})
+                yield ("error", {"員工": current_employee, "異常類型": "換人前無下班紀錄", "打卡時間": current_clock_in})
+                yield ("session", {"員工": current_employee, "上班時間": current_clock_in, "下班時間": pd.NaT})
             current_employee = action
             current_clock_in = None
 
@@ -72,44 +94,400 @@ def clean_ichef_data(file):
                     if abs((t2 - t1).total_seconds()) / 60.0 <= 10:
                         pass 
                     else:
-                        error_log.append({"員工": current_employee, "異常類型": "連續上班打卡", "打卡時間": current_clock_in})
-                        cleaned_data.append({"員工": current_employee, "上班時間": current_clock_in, "下班時間": pd.NaT})
+                        yield ("error", {"員工": current_employee, "異常類型": "連續上班打卡", "打卡時間": current_clock_in})
+                        yield ("session", {"員工": current_employee, "上班時間": current_clock_in, "下班時間": pd.NaT})
                         current_clock_in = time_record
                 except:
-                    cleaned_data.append({"員工": current_employee, "上班時間": current_clock_in, "下班時間": pd.NaT})
+                    yield ("session", {"員工": current_employee, "上班時間": current_clock_in, "下班時間": pd.NaT})
                     current_clock_in = time_record
             else:
                 current_clock_in = time_record
 
         elif action == "下班":
             if current_clock_in is not None:
-                cleaned_data.append({"員工": current_employee, "上班時間": current_clock_in, "下班時間": time_record})
+                yield ("session", {"員工": current_employee, "上班時間": current_clock_in, "下班時間": time_record})
                 current_clock_in = None
             else:
-                error_log.append({"員工": current_employee, "異常類型": "有下班無上班", "打卡時間": time_record})
-                cleaned_data.append({"員工": current_employee, "上班時間": pd.NaT, "下班時間": time_record})
+                yield ("error", {"員工": current_employee, "異常類型": "有下班無上班", "打卡時間": time_record})
+                yield ("session", {"員工": current_employee, "上班時間": pd.NaT, "下班時間": time_record})
 
         elif "無下班" in action:
-            error_log.append({"員工": current_employee, "異常類型": "系統標記無下班", "打卡時間": current_clock_in if current_clock_in else time_record})
+            yield ("error", {"員工": current_employee, "異常類型": "系統標記無下班", "打卡時間": current_clock_in if current_clock_in else time_record})
             if current_clock_in is not None:
-                cleaned_data.append({"員工": current_employee, "上班時間": current_clock_in, "下班時間": pd.NaT})
+                yield ("session", {"員工": current_employee, "上班時間": current_clock_in, "下班時間": pd.NaT})
             current_clock_in = None
             
         elif "無上班" in action:
-            error_log.append({"員工": current_employee, "異常類型": "系統標記無上班", "打卡時間": time_record})
-            cleaned_data.append({"員工": current_employee, "上班時間": pd.NaT, "下班時間": time_record})
+            yield ("error", {"員工": current_employee, "異常類型": "系統標記無上班", "打卡時間": time_record})
+            yield ("session", {"員工": current_employee, "上班時間": pd.NaT, "下班時間": time_record})
             current_clock_in = None
 
     if current_clock_in is not None:
-        error_log.append({"員工": current_employee, "異常類型": "最後一筆無下班", "打卡時間": current_clock_in})
-        cleaned_data.append({"員工": current_employee, "上班時間": current_clock_in, "下班時間": pd.NaT})
+        yield ("error", {"員工": current_employee, "異常類型": "最後一筆無下班", "打卡時間": current_clock_in})
+        yield ("session", {"員工": current_employee, "上班時間": current_clock_in, "下班時間": pd.NaT})
+
+def clean_ichef_data(file):
+    cleaned_data = []
+    error_log = []
+    raw_data = pd.read_excel(file, header=None)
+
+    for kind, record in iter_ichef_records(raw_data.itertuples(index=False, name=None)):
+        if kind == "session":
+            cleaned_data.append(record)
+        else:
+            error_log.append(record)
 
     return pd.DataFrame(cleaned_data), pd.DataFrame(error_log)
 
+def iter_ichef_rows(file):
+    # read_only 模式逐列讀取，不將整份匯出檔載入成 DataFrame
+    wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        for row in ws.iter_rows(max_col=2, values_only=True):
+            row = tuple("nan" if v is None else v for v in row)
+            yield row + ("nan",) * (2 - len(row))
+    finally:
+        wb.close()
+
+def iter_ichef_employee_partitions(rows):
+    """依 iCHEF 匯出檔的員工區段分批產出 (員工, 打卡段列表, 異常列表)。
+
+    一次只保留一位員工的打卡段；同一員工在匯出檔中若出現多個區段，會分別產出，由呼叫端合併。
+    """
+    current_emp = None
+    sessions, errors = [], []
+    for kind, record in iter_ichef_records(rows):
+        emp = record["員工"]
+        if emp != current_emp:
+            if current_emp is not None and (sessions or errors):
+                yield current_emp, sessions, errors
+            current_emp = emp
+            sessions, errors = [], []
+        if kind == "session":
+            sessions.append(record)
+        else:
+            errors.append(record)
+    if current_emp is not None and (sessions or errors):
+        yield current_emp, sessions, errors
+
+# ==========================================
+# 全站產出物倉儲：以輸入雜湊去重，跨 session 共用
+# ==========================================
+ARTIFACT_STORE_DIR = os.path.join("data", "processed", "artifacts")
+ARTIFACT_STORE_MAX_BYTES = 512 * 1024 * 1024
+ARTIFACT_DISK_MAX_BYTES = 4 * 1024 * 1024 * 1024
+ARTIFACT_TTL_SECONDS = 12 * 3600
+
+def new_artifact_store(max_bytes=ARTIFACT_STORE_MAX_BYTES, disk_max_bytes=ARTIFACT_DISK_MAX_BYTES,
+                       ttl_seconds=ARTIFACT_TTL_SECONDS, spill_dir=ARTIFACT_STORE_DIR):
+    os.makedirs(spill_dir, exist_ok=True)
+    # 溢寫目錄可能由多個伺服器行程共用：只清除超過保存期限、已不可能被任何索引引用的遺留檔
+    cutoff = time.time() - ttl_seconds
+    for fn in os.listdir(spill_dir):
+        path = os.path.join(spill_dir, fn)
+        try:
+            if fn.endswith(".pkl") and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+    return {
+        "items": OrderedDict(), "bytes": 0, "disk_bytes": 0,
+        "max_bytes": max_bytes, "disk_max_bytes": disk_max_bytes, "ttl": ttl_seconds,
+        "spill_dir": spill_dir, "spill_prefix": f"{os.getpid()}-", "lock": threading.Lock()
+    }
+
+def artifact_key(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        data = part if isinstance(part, bytes) else str(part).encode('utf-8')
+        h.update(str(len(data)).encode('ascii') + b":")
+        h.update(data)
+    return h.hexdigest()
+
+def estimate_artifact_bytes(value):
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_artifact_bytes(v) for v in value.values())
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(estimate_artifact_bytes(v) for v in value)
+    return sys.getsizeof(value)
+
+def _drop_artifact(store, key):
+    entry = store["items"].pop(key)
+    if entry["value"] is not None:
+        store["bytes"] -= entry["size"]
+    if entry["path"]:
+        store["disk_bytes"] -= entry["disk_size"]
+        try:
+            os.remove(entry["path"])
+        except OSError:
+            pass
+
+def _spill_artifact(store, key, entry):
+    # 檔名帶行程代號，不同行程的相同鍵值不會互相覆寫或刪除
+    path = os.path.join(store["spill_dir"], f"{store['spill_prefix']}{key}.pkl")
+    try:
+        with open(path, "wb") as f:
+            pickle.dump(entry["value"], f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        if os.path.exists(path):
+            os.remove(path)
+        _drop_artifact(store, key)
+        return
+    entry["path"] = path
+    entry["disk_size"] = os.path.getsize(path)
+    store["disk_bytes"] += entry["disk_size"]
+    store["bytes"] -= entry["size"]
+    entry["value"] = None
+
+def _enforce_artifact_limits(store, now):
+    items = store["items"]
+    for key in [k for k, e in items.items() if now - e["created"] > store["ttl"]]:
+        _drop_artifact(store, key)
+    # 記憶體超量時，自最久未使用者起溢寫至磁碟
+    for key in list(items.keys()):
+        if store["bytes"] <= store["max_bytes"]:
+            break
+        if items[key]["value"] is not None:
+            _spill_artifact(store, key, items[key])
+    # 磁碟亦超量時，直接淘汰最久未使用的溢寫檔
+    for key in list(items.keys()):
+        if store["disk_bytes"] <= store["disk_max_bytes"]:
+            break
+        if items[key]["path"]:
+            _drop_artifact(store, key)
+
+def artifact_store_get(store, key):
+    if not key:
+        return None
+    with store["lock"]:
+        now = time.time()
+        _enforce_artifact_limits(store, now)
+        entry = store["items"].get(key)
+        if entry is None:
+            return None
+        if entry["value"] is None:
+            try:
+                with open(entry["path"], "rb") as f:
+                    entry["value"] = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                _drop_artifact(store, key)
+                return None
+            os.remove(entry["path"])
+            store["disk_bytes"] -= entry["disk_size"]
+            store["bytes"] += entry["size"]
+            entry["path"] = None
+        store["items"].move_to_end(key)
+        value = entry["value"]
+        _enforce_artifact_limits(store, now)
+        return value
+
+def artifact_store_put(store, key, value):
+    with store["lock"]:
+        now = time.time()
+        if key in store["items"]:
+            _drop_artifact(store, key)
+        size = estimate_artifact_bytes(value)
+        store["items"][key] = {"value": value, "size": size, "created": now, "path": None, "disk_size": 0}
+        store["bytes"] += size
+        _enforce_artifact_limits(store, now)
+    return value
+
+# ==========================================
+# 打卡紀錄累加合併：重疊匯出檔去重後，只重新清洗新涵蓋的日期
+# ==========================================
+PUNCH_LOG_DIR = os.path.join("data", "processed", "punch_logs")
+PUNCH_EVENT_COLUMNS = ['員工', '動作', '時間', '排序時間']
+_PUNCH_LOG_LOCK = threading.Lock()
+
+def _is_punch_action(action):
+    return action in ("上班", "下班") or "無下班" in action or "無上班" in action
+
+def iter_ichef_punch_events(rows):
+    """將 iCHEF 匯出內容攤平為 (員工, 動作, 時間) 事件，供去重合併。"""
+    current_employee = ""
+    for row in rows:
+        action = str(row[0]).strip()
+        time_record = str(row[1]).strip()
+        if action in ICHEF_SYSTEM_KEYWORDS or "總時數" in action:
+            if _is_punch_action(action):
+                yield current_employee, action, time_record
+        elif action != "":
+            current_employee = action
+
+def punch_events_frame(rows):
+    df = pd.DataFrame(list(iter_ichef_punch_events(rows)), columns=PUNCH_EVENT_COLUMNS[:3])
+    # 「無下班記錄」等列可能沒有時間，排序時沿用同一員工前一筆事件的時間
+    df['排序時間'] = pd.to_datetime(df['時間'], errors='coerce')
+    df['排序時間'] = df.groupby('員工', sort=False)['排序時間'].ffill()
+    return df
+
+def _punch_event_keys(df):
+    stamp = pd.to_datetime(df['時間'], errors='coerce')
+    timed = stamp.notna()
+    # 可解析者以時間值比對，避免同一筆打卡在不同匯出檔中格式不同而重複
+    time_key = stamp.dt.strftime('%Y-%m-%d %H:%M:%S')
+    # 「無下班記錄」等沒有時間的標記列，以同一員工前一筆有時間的事件及其後的序號定位：
+    # 同一匯出檔中的多筆標記不會互相吃掉，不同匯出檔中的同一筆標記仍能比對為重複
+    emp = df['員工']
+    prev = (df['動作'].astype(str) + " " + time_key).where(timed).groupby(emp, sort=False).ffill().fillna("")
+    seq = df.groupby([emp, timed.groupby(emp, sort=False).cumsum()], sort=False).cumcount()
+    marker_key = "後於 " + prev + " #" + seq.astype(str)
+    return pd.MultiIndex.from_arrays([emp, df['動作'], time_key.where(timed, marker_key)])
+
+def _record_anchor(df, cols, fallback):
+    anchor = pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns]')
+    for col in cols:
+        if col in df.columns:
+            anchor = anchor.fillna(pd.to_datetime(df[col], errors='coerce'))
+    return anchor.fillna(fallback)
+
+def replay_employee_events(emp, events, start):
+    """自 start 起以原狀態機重播單一員工的事件，產出打卡段與異常，並標記錨點時間供下次合併比對。"""
+    rows = [(emp, "nan")] + list(zip(events['動作'], events['時間']))
+    sessions, errors = [], []
+    for kind, record in iter_ichef_records(rows):
+        (sessions if kind == "session" else errors).append(record)
+    df_s = pd.DataFrame(sessions, columns=PUNCH_COLUMNS)
+    df_e = pd.DataFrame(errors, columns=['員工', '異常類型', '打卡時間'])
+    df_s['錨點'] = _record_anchor(df_s, ['上班時間', '下班時間'], start)
+    df_e['錨點'] = _record_anchor(df_e, ['打卡時間'], start)
+    return df_s, df_e
+
+def _replay_start(stored_sessions, first_new):
+    # 回溯一天涵蓋跨日班，並退回至跨越邊界或尚未收尾的打卡段起點，確保重播開始時狀態機為空
+    start = first_new.normalize() - pd.Timedelta(days=1)
+    if stored_sessions.empty:
+        return start
+    ins = pd.to_datetime(stored_sessions['上班時間'], errors='coerce')
+    outs = pd.to_datetime(stored_sessions['下班時間'], errors='coerce')
+    straddling = ins[(ins < start) & (outs >= start)]
+    if not straddling.empty:
+        start = min(start, straddling.min())
+    # 前一份匯出檔結尾的「上班」尚未配對，其下班可能落在本次匯出檔中
+    last = stored_sessions['錨點'].idxmax()
+    if pd.notna(ins[last]) and pd.isna(outs[last]):
+        start = min(start, ins[last])
+    return start
+
+def punch_log_path(store_id, log_dir=PUNCH_LOG_DIR):
+    # 各店紀錄以代號分檔，不提供預設代號，避免多店誤用同一份紀錄
+    safe = "".join(c if c.isalnum() or c in "-_" else "_" for c in normalize_employee_name(store_id or ""))
+    if not safe.strip("_"):
+        raise ValueError("累加合併模式需指定店鋪代號。")
+    return os.path.join(log_dir, f"{safe}.pkl")
+
+def load_punch_log(store_id, log_dir=PUNCH_LOG_DIR):
+    path = punch_log_path(store_id, log_dir)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    anchor = pd.Series(dtype='datetime64[ns]')
+    return {
+        "events": pd.DataFrame({'員工': [], '動作': [], '時間': [], '排序時間': anchor}),
+        "sessions": pd.DataFrame({'員工': [], '上班時間': [], '下班時間': [], '錨點': anchor}),
+        "errors": pd.DataFrame({'員工': [], '異常類型': [], '打卡時間': [], '錨點': anchor}),
+        "employees": []
+    }
+
+def save_punch_log(store_id, log, log_dir=PUNCH_LOG_DIR):
+    os.makedirs(log_dir, exist_ok=True)
+    path = punch_log_path(store_id, log_dir)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(log, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+def _order_by_employee(df, rank, time_col):
+    ordered = df.assign(_rank=df['員工'].map(rank)).sort_values(['_rank', time_col], kind='mergesort', na_position='first')
+    return ordered.drop(columns='_rank').reset_index(drop=True)
+
+def merge_punch_events(log, new_events):
+    """將新匯出檔的事件去重併入紀錄，並只重播受影響員工自新事件前一天起的區段。"""
+    events = log["events"]
+    # 鍵值須以完整匯出檔計算一次：標記列的鍵值取決於其前一筆事件
+    new_keys = _punch_event_keys(new_events)
+    fresh = new_events[~new_keys.isin(_punch_event_keys(events)) & ~new_keys.duplicated()]
+    stats = {"新事件": len(fresh), "重複事件": len(new_events) - len(fresh), "重新清洗": {}}
+    if fresh.empty:
+        return log, stats
+
+    employees = list(log["employees"])
+    for emp in fresh['員工'].unique():
+        if emp not in employees:
+            employees.append(emp)
+    events = pd.concat([events, fresh], ignore_index=True)
+    rank = {emp: i for i, emp in enumerate(employees)}
+    events = _order_by_employee(events, rank, '排序時間')
+
+    sessions, errors = log["sessions"], log["errors"]
+    for emp, emp_fresh in fresh.groupby('員工', sort=False):
+        first_new = emp_fresh['排序時間'].min()
+        emp_mask = events['員工'] == emp
+        if pd.notna(first_new):
+            start = _replay_start(sessions[sessions['員工'] == emp], first_new)
+            emp_mask &= events['排序時間'] >= start
+        else:
+            # 新事件完全沒有可定位的時間時，該員工整段重播
+            start = pd.Timestamp.min
+        new_s, new_e = replay_employee_events(emp, events[emp_mask], start)
+        sessions = pd.concat([sessions[(sessions['員工'] != emp) | (sessions['錨點'] < start)], new_s], ignore_index=True)
+        errors = pd.concat([errors[(errors['員工'] != emp) | (errors['錨點'] < start)], new_e], ignore_index=True)
+        stats["重新清洗"][emp] = None if start == pd.Timestamp.min else start.date()
+
+    # 依員工首次出現順序與時間排列，與單次清洗的輸出順序一致
+    sessions = _order_by_employee(sessions, rank, '錨點')
+    errors = _order_by_employee(errors, rank, '錨點')
+    return {"events": events, "sessions": sessions, "errors": errors, "employees": employees}, stats
+
+def ingest_ichef_export(store_id, file, log_dir=PUNCH_LOG_DIR):
+    """將 iCHEF 匯出檔累加合併至店鋪打卡紀錄，回傳 (打卡段, 異常, 合併統計)。
+
+    打卡段與異常涵蓋紀錄全部歷史並保留「錨點」欄，需經 trim_punch_log_to_roster 篩選至班表月份後才進入結算。
+    """
+    new_events = punch_events_frame(iter_ichef_rows(file))
+    with _PUNCH_LOG_LOCK:
+        log, stats = merge_punch_events(load_punch_log(store_id, log_dir), new_events)
+        if stats["新事件"]:
+            save_punch_log(store_id, log, log_dir)
+    # 紀錄內容的雜湊作為第一階段快取鍵，取代原始上傳檔
+    stats["版本"] = artifact_key(pd.util.hash_pandas_object(log["events"][['員工', '動作', '時間']], index=False).values.tobytes())
+    return log["sessions"], log["errors"], stats
+
+# 班表首日前與末日後各保留一天，讓跨月的大夜班與前一天延續的打卡仍能歸屬
+PUNCH_LOG_MARGIN_DAYS = 1
+
+def roster_punch_window(df_roster, margin_days=PUNCH_LOG_MARGIN_DAYS):
+    """班表日期範圍前後各延伸 margin_days 日的打卡篩選區間 [lo, hi)；班表無有效日期時回傳 None。"""
+    dates = pd.to_datetime(df_roster['日期'], errors='coerce').dropna()
+    if dates.empty:
+        return None
+    return (dates.min().normalize() - pd.Timedelta(days=margin_days),
+            dates.max().normalize() + pd.Timedelta(days=margin_days + 1))
+
+def trim_punch_log_to_roster(df_sessions, df_errors, df_roster, margin_days=PUNCH_LOG_MARGIN_DAYS):
+    """將店鋪紀錄篩選至班表日期範圍，轉為與 clean_ichef_data 相同格式的 (打卡段, 異常)。"""
+    window = roster_punch_window(df_roster, margin_days)
+    if window is None:
+        keep_s = pd.Series(False, index=df_sessions.index)
+        keep_e = pd.Series(False, index=df_errors.index)
+    else:
+        lo, hi = window
+        keep_s = (df_sessions['錨點'] >= lo) & (df_sessions['錨點'] < hi)
+        keep_e = (df_errors['錨點'] >= lo) & (df_errors['錨點'] < hi)
+    return (df_sessions[keep_s].drop(columns='錨點').reset_index(drop=True),
+            df_errors[keep_e].drop(columns='錨點').reset_index(drop=True))
+
 # ==========================================
 # 模組二：強固型班表攤平
 # ==========================================
-def parse_roster_data(file, target_sheet):
+def parse_roster_data(file, target_sheet, shift_rules=None):
+    # 班表格內容與規則檔中的班別名稱 (如「早班」) 相同時沿用該名稱，其餘非 HHMM-HHMM 內容視為正常班
+    shift_rules = shift_rules or DEFAULT_COMPILED_SHIFT_RULES
     raw_roster = pd.read_excel(file, sheet_name=target_sheet, header=None)
     roster_list = []
     
@@ -147,6 +525,7 @@ def parse_roster_data(file, target_sheet):
             for col_idx, info in employee_info.items():
                 emp_name = info["name"]
                 is_pt = info["is_pt"]
+                named_shifts = shift_rules["pt" if is_pt else "full"]
                 shift_val = str(row[col_idx]).strip()
                 
                 is_working = False
@@ -158,6 +537,9 @@ def parse_roster_data(file, target_sheet):
                     else:
                         is_working = True
                         shift_string = "正常班"
+                elif shift_val in named_shifts:
+                    is_working = True
+                    shift_string = shift_val
                 elif any(x in shift_val for x in ["休", "假", "曠"]):
                     is_working = False
                     shift_string = "休"
@@ -248,253 +630,49 @@ def parse_standard_anomaly_data(file, sheet_name=None):
         return pd.DataFrame()
 
 # ==========================================
-# 核心引擎：工時碰撞 (支援多重打卡免疫與物理時段分割)
+# 分段處理模式：依員工分區逐批結算大型匯出檔
 # ==========================================
-def calculate_payroll_hours(df_roster, df_actual, df_anomaly):
-    results = []
-    audit_logs = []
-    
-    # 無條件抹除秒數，杜絕 15:00:59 引發的判定誤差
-    df_actual['上班時間'] = pd.to_datetime(df_actual['上班時間']).dt.floor('T')
-    df_actual['下班時間'] = pd.to_datetime(df_actual['下班時間']).dt.floor('T')
-    df_actual['temp_time'] = df_actual['上班時間'].fillna(df_actual['下班時間'])
-    df_actual['日期'] = df_actual['temp_time'].dt.strftime('%Y-%m-%d')
-    
-    for _, scheduled in df_roster.iterrows():
-        date = scheduled['日期']
-        emp = scheduled['員工']
-        emp_type = scheduled['身份']
-        original_shift_str = scheduled['班別字串']
-        is_working = scheduled['表定上班狀態']
-        
-        emp_punches = df_actual[(df_actual['員工'] == emp) & (df_actual['日期'] == date)]
-        
-        shift_str = original_shift_str
-        manual_add_ot = 0.0
-        missing_punch_dts = []
-        override_reasons = []
-        has_override = False
-        waive_penalty = False 
-        
-        if not df_anomaly.empty:
-            emp_anomalies = df_anomaly[(df_anomaly['日期'] == date) & (df_anomaly['員工'] == emp)]
-            for _, anom in emp_anomalies.iterrows():
-                cmd = anom['指令']
-                reason = str(anom['原因'])
-                exact_time = str(anom['精確時間']).strip() if pd.notna(anom['精確時間']) else ""
-                time_range = str(anom['時數異動脈絡']).strip() if pd.notna(anom['時數異動脈絡']) else ""
-                
-                if cmd == "變更為排休":
-                    shift_str = "休"
-                    is_working = False
-                    has_override = True
-                    waive_penalty = True
-                    override_reasons.append(f"調休變更: {reason}")
-                elif cmd == "變更為應勤":
-                    shift_str = "正常班"
-                    is_working = True
-                    has_override = True
-                    waive_penalty = True
-                    override_reasons.append(f"調休變更: {reason}")
-                elif cmd in ["補登上班", "補登下班", "上班補登", "下班補登"]:
-                    if exact_time:
-                        ts = exact_time
-                        if len(ts) == 5: ts += ":00"
-                        try:
-                            dt = pd.to_datetime(f"{date} {ts}").floor('T')
-                            missing_punch_dts.append(dt)
-                            has_override = True
-                            override_reasons.append(f"{cmd} {ts}: {reason}")
-                        except: pass
-                elif cmd == "時數增減":
-                    if anom['時數'] != 0.0:
-                        manual_add_ot += anom['時數']
-                        has_override = True
-                        waive_penalty = True 
-                        if time_range and time_range.lower() not in ["nan", "none", ""]:
-                            override_reasons.append(f"時數增減 {anom['時數']}H [{time_range}]: {reason}")
-                        else:
-                            override_reasons.append(f"時數增減 {anom['時數']}H: {reason}")
-
-        raw_times = []
-        for _, punch in emp_punches.iterrows():
-            if pd.notna(punch['上班時間']): raw_times.append(punch['上班時間'])
-            if pd.notna(punch['下班時間']): raw_times.append(punch['下班時間'])
-        raw_times.extend(missing_punch_dts)
-        raw_times.sort()
-
-        # 【第一道絕對防禦：打卡訊號淨化器】
-        # 無情抹除所有 20 分鐘內的重複打卡，還原真實的 In/Out 軌跡
-        all_times = []
-        if raw_times:
-            all_times = [raw_times[0]]
-            for t in raw_times[1:]:
-                if (t - all_times[-1]).total_seconds() / 60.0 > 20:
-                    all_times.append(t)
-        
-        if not is_working and not all_times:
-            if has_override and manual_add_ot != 0:
-                results.append({"日期": date, "員工": emp, "身份": emp_type, "班別": shift_str, "遲到(分)": 0, "早退(分)": 0, "加班(時)": manual_add_ot, "總工時(時)": 0, "狀態": "已套用異常覆寫"})
-                audit_logs.append({"日期": date, "員工": emp, "原始判定": "排休無打卡", "覆寫內容": "已執行上述指令", "幹部備註原因": " | ".join(override_reasons)})
-            continue
-            
-        if is_working and not all_times:
-            final_status = "已套用異常覆寫" if has_override else "無打卡紀錄(曠職或未核)"
-            results.append({"日期": date, "員工": emp, "身份": emp_type, "班別": shift_str, "遲到(分)": 0, "早退(分)": 0, "加班(時)": manual_add_ot, "總工時(時)": 0, "狀態": final_status})
-            if has_override:
-                audit_logs.append({"日期": date, "員工": emp, "原始判定": "曠職或未核", "覆寫內容": "已執行上述指令", "幹部備註原因": " | ".join(override_reasons)})
-            continue
+def calculate_payroll_hours_chunked(df_roster, ichef_file, df_anomaly, emp_master=None, shift_rules=None):
+    """分段處理模式：逐一讀入員工打卡區段，不需建立整份匯出檔的 DataFrame。
 
-        actual_in = all_times[0]
-        span_hours = (all_times[-1] - actual_in).total_seconds() / 3600.0
+    不在班表上的員工之打卡段讀入即捨棄，其餘只保留班表期間前後 PUNCH_LOG_MARGIN_DAYS 日內者，
+    暫存量以每位班表員工一個月的打卡段為上限；匯出檔讀完後每位員工只結算一次。
+    """
+    if emp_master is None:
+        emp_master = build_employee_master({
+            "班表": df_roster['員工'],
+            "異常表": df_anomaly['員工'] if not df_anomaly.empty else []
+        })
+    roster_parts = partition_by_employee(df_roster, emp_master)
+    anomaly_parts = partition_by_employee(df_anomaly, emp_master)
+    window = roster_punch_window(df_roster)
 
-        if not is_working and all_times:
-            snapped_times = [snap_punch_time(t, is_in=(i % 2 == 0)) for i, t in enumerate(all_times)]
-            if len(snapped_times) % 2 == 0:
-                total_actual_hours = sum([max(0, (snapped_times[i+1] - snapped_times[i]).total_seconds() / 3600.0) for i in range(0, len(snapped_times)-1, 2)])
-            else:
-                total_actual_hours = max(0, (snap_punch_time(all_times[-1], False) - snap_punch_time(all_times[0], True)).total_seconds() / 3600.0)
-                
-            support_ot = total_actual_hours + manual_add_ot
-            results.append({"日期": date, "員工": emp, "身份": emp_type, "班別": shift_str, "遲到(分)": 0, "早退(分)": 0, "加班(時)": support_ot, "總工時(時)": round(total_actual_hours, 2), "狀態": "休假支援(全額加班)"})
-            if has_override: audit_logs.append({"日期": date, "員工": emp, "原始判定": "休假支援", "覆寫內容": "已執行上述指令", "幹部備註原因": " | ".join(override_reasons)})
+    emp_sessions, error_log = {}, []
+    for emp, sessions, errors in iter_ichef_employee_partitions(iter_ichef_rows(ichef_file)):
+        error_log.extend(errors)
+        register_employee_names(emp_master, "iCHEF打卡", [emp])
+        emp_id = lookup_employee_id(emp_master, emp)
+        if emp_id not in roster_parts or window is None or not sessions:
             continue
+        block = pd.DataFrame(sessions, columns=PUNCH_COLUMNS)
+        anchor = _record_anchor(block, ['上班時間', '下班時間'], pd.NaT)
+        block = block[(anchor >= window[0]) & (anchor < window[1])]
+        # 多店合併匯出檔中同一員工可能出現多個區段：先收集，待整份讀完再一併結算
+        if not block.empty:
+            emp_sessions.setdefault(emp_id, []).append(block)
 
-        if emp_type == "PT":
-            total_actual_hours = 0
-            if shift_str == "1100-2200":
-                sched1_in = pd.to_datetime(f"{date} 11:00:00")
-                sched2_in = pd.to_datetime(f"{date} 17:00:00")
-                
-                seg1 = [t for t in all_times if t.hour < 15 or (t.hour == 15 and t.minute <= 30)]
-                seg2 = [t for t in all_times if t not in seg1]
-                
-                if seg1 and len(seg1) >= 2:
-                    in1 = max(seg1[0], sched1_in)
-                    out1 = seg1[-1]
-                    total_actual_hours += max(0, (out1 - in1).total_seconds() / 3600.0)
-                if seg2 and len(seg2) >= 2:
-                    in2 = max(seg2[0], sched2_in)
-                    out2 = seg2[-1]
-                    total_actual_hours += max(0, (out2 - in2).total_seconds() / 3600.0)
-                if not seg1 and not seg2:
-                    total_actual_hours = sum([(all_times[i+1] - all_times[i]).total_seconds() / 3600.0 for i in range(0, len(all_times)-1, 2)]) if len(all_times) % 2 == 0 else span_hours
-            elif shift_str != "正常班" and "-" in shift_str:
-                try:
-                    s_str = shift_str.split('-')[0]
-                    sched_in = pd.to_datetime(f"{date} {s_str[:2]}:{s_str[2:]}")
-                    in_time = max(all_times[0], sched_in)
-                    out_time = all_times[-1]
-                    total_actual_hours += max(0, (out_time - in_time).total_seconds() / 3600.0)
-                except:
-                    total_actual_hours = (all_times[-1] - all_times[0]).total_seconds() / 3600.0 if len(all_times) >= 2 else 0
-            else:
-                total_actual_hours = (all_times[-1] - all_times[0]).total_seconds() / 3600.0 if len(all_times) >= 2 else 0
-
-            pt_mins = round(total_actual_hours * 60.0, 2)
-            pt_hours = (pt_mins // 30) * 0.5
-            pt_hours += manual_add_ot
-            
-            final_status = "已套用異常覆寫" if has_override else "PT時數結算"
-            results.append({"日期": date, "員工": emp, "身份": emp_type, "班別": shift_str, "遲到(分)": 0, "早退(分)": 0, "加班(時)": manual_add_ot, "總工時(時)": pt_hours, "狀態": final_status})
-            if has_override: audit_logs.append({"日期": date, "員工": emp, "原始判定": "PT工時結算", "覆寫內容": "已執行上述指令", "幹部備註原因": " | ".join(override_reasons)})
-            continue
-            
-        late_mins = 0
-        early_leave_mins = 0
-        total_calculated_hours = 0
-        
-        if shift_str == "正常班":
-            if actual_in.hour < 13 or len(all_times) >= 3:
-                sched1_in, sched1_out = pd.to_datetime(f"{date} 11:00:00"), pd.to_datetime(f"{date} 14:30:00")
-                sched2_in, sched2_out = pd.to_datetime(f"{date} 17:00:00"), pd.to_datetime(f"{date} 23:00:00")
-                
-                # 【第二道絕對防禦：時段物理分割】
-                # 強制以 15:30 為界拆分打卡陣列。徹底免疫任何未知的多重打卡陣列錯位。
-                seg1 = [t for t in all_times if t.hour < 15 or (t.hour == 15 and t.minute <= 30)]
-                seg2 = [t for t in all_times if t not in seg1]
-                
-                h1 = 0.0
-                if seg1:
-                    s1_act_in = seg1[0]
-                    s1_act_out = seg1[-1]
-                    if s1_act_in > sched1_in: late_mins += int((s1_act_in - sched1_in).total_seconds() / 60)
-                    s1_in = max(s1_act_in, sched1_in)
-                    s1_out = min(s1_act_out, sched1_out)
-                    if s1_out > s1_in: h1 = (s1_out - s1_in).total_seconds() / 3600.0
-                    
-                h2 = 0.0
-                if seg2:
-                    s2_act_in = seg2[0]
-                    s2_act_out = seg2[-1]
-                    if s2_act_in > sched2_in: late_mins += int((s2_act_in - sched2_in).total_seconds() / 60)
-                    s2_in = max(s2_act_in, sched2_in)
-                    
-                    if s2_act_out < sched2_out and (sched2_out - s2_act_out).total_seconds() <= 1800:
-                        s2_out = sched2_out
-                    else:
-                        s2_out = min(s2_act_out, sched2_out)
-                        diff = int((sched2_out - s2_act_out).total_seconds() / 60)
-                        if diff > 30: early_leave_mins = diff
-                        
-                    if s2_out > s2_in: h2 = (s2_out - s2_in).total_seconds() / 3600.0
-                    
-                total_calculated_hours = h1 + h2
-                base_hours = 8.5
-            else:
-                sched_in, sched_out = pd.to_datetime(f"{date} 15:00:00"), pd.to_datetime(f"{date} 23:00:00")
-                s_act_in = all_times[0]
-                s_act_out = all_times[-1]
-                
-                if s_act_in > sched_in: late_mins += int((s_act_in - sched_in).total_seconds() / 60)
-                if s_act_out < sched_out:
-                    diff = int((sched_out - s_act_out).total_seconds() / 60)
-                    if diff > 30: early_leave_mins = diff
-                    valid_out = s_act_out
-                else: 
-                    valid_out = min(s_act_out, sched_out)
-                    
-                valid_in = max(s_act_in, sched_in)
-                if valid_out > valid_in:
-                    total_calculated_hours = (valid_out - valid_in).total_seconds() / 3600.0
-                base_hours = 8.0
-        else:
-            try:
-                s_str, e_str = shift_str.split('-')
-                sched_in = pd.to_datetime(f"{date} {s_str[:2]}:{s_str[2:]}")
-                sched_out = pd.to_datetime(f"{date} {e_str[:2]}:{e_str[2:]}")
-                if sched_out < sched_in: sched_out += timedelta(days=1)
-                
-                s_act_in = all_times[0]
-                s_act_out = all_times[-1]
-                if s_act_in > sched_in: late_mins += int((s_act_in - sched_in).total_seconds() / 60)
-                if s_act_out < sched_out:
-                    diff = int((sched_out - s_act_out).total_seconds() / 60)
-                    if diff > 30: early_leave_mins = diff
-                    valid_out = s_act_out
-                else: 
-                    valid_out = min(s_act_out, sched_out)
-                    
-                valid_in = max(s_act_in, sched_in)
-                if valid_out > valid_in:
-                    total_calculated_hours = (valid_out - valid_in).total_seconds() / 3600.0
-                base_hours = (sched_out - sched_in).total_seconds() / 3600.0
-            except: 
-                base_hours = 8.5
-
-        if waive_penalty:
-            late_mins = 0
-            early_leave_mins = 0
-                
-        overflow = total_calculated_hours - base_hours
-        overtime_hours = (overflow // 0.5) * 0.5 if overflow > 0 else 0
-        overtime_hours += manual_add_ot
-        final_status = "已套用異常覆寫" if has_override else "正常結算"
-            
-        results.append({"日期": date, "員工": emp, "身份": "正職", "班別": shift_str, "遲到(分)": late_mins, "早退(分)": early_leave_mins, "加班(時)": overtime_hours, "總工時(時)": round(total_calculated_hours, 2), "狀態": final_status})
-        if has_override: audit_logs.append({"日期": date, "員工": emp, "原始判定": "異常/正常結算", "覆寫內容": "已執行上述指令", "幹部備註原因": " | ".join(override_reasons)})
+    # 班表上有排班但匯出檔完全沒有打卡的員工，仍需結算曠職或排休紀錄
+    settled = {}
+    for emp_id, roster_part in roster_parts.items():
+        blocks = emp_sessions.pop(emp_id, [])
+        df_punch = pd.concat(blocks, ignore_index=True) if blocks else pd.DataFrame(columns=PUNCH_COLUMNS)
+        settled[emp_id] = calculate_payroll_hours(roster_part, df_punch, anomaly_parts.get(emp_id, pd.DataFrame()), emp_master, shift_rules)
 
-    return pd.DataFrame(results), pd.DataFrame(audit_logs)
+    results = [res for res, _ in settled.values()]
+    audits = [aud for _, aud in settled.values()]
+    df_results = order_like_roster(pd.concat(results, ignore_index=True) if results else pd.DataFrame(), df_roster, emp_master)
+    df_audit = order_like_roster(pd.concat(audits, ignore_index=True) if any(not a.empty for a in audits) else pd.DataFrame(), df_roster, emp_master)
+    return df_results, df_audit, pd.DataFrame(error_log)
 
 # ==========================================
 # 模組四：人事資料庫主導之最終薪資引擎
@@ -544,28 +722,108 @@ def parse_salary_params(file):
     except Exception as e:
         return None, None, None, None, None, None, "薪資與獎金設定表讀取失敗，請確認檔案結構。"
 
-def generate_final_payslip(df_calc, df_fixed, df_var, dynamic_bonus_cols, dynamic_fixed_cols, df_hr_reward, hr_reward_pairs):
-    if not df_calc.empty:
-        summary = df_calc.groupby('員工').agg({
-            '遲到(分)': 'sum',
-            '早退(分)': 'sum',
-            '加班(時)': 'sum',
-            '總工時(時)': 'sum',
-            '身份': 'first'
-        }).reset_index()
-    else:
+def index_rows_by_employee(df, master, name_col='員工姓名'):
+    # 同一員工重複出現時以第一列為準，與原本 .values[0] 的取值行為一致
+    if df is None or df.empty or name_col not in df.columns:
+        return {}
+    row_index = {}
+    for pos, raw in enumerate(df[name_col].values):
+        emp_id = lookup_employee_id(master, raw)
+        if emp_id is not None and emp_id not in row_index:
+            row_index[emp_id] = pos
+    return row_index
+
+def compute_payslip_money_cents(df_in, n_reward_pairs):
+    """整欄向量化計算各員工金額 (單位：分)。時薪以「本薪分 / 240」有理數保存，不先行四捨五入。"""
+    is_ft = (df_in['身份'] == "正職").to_numpy()
+    base_c = to_cents(df_in['本薪或時薪'])
+    rate_num = base_c
+    rate_den = np.where(is_ft & (base_c > 0), 240, 1).astype(object)
+    q = MONEY_QTY_SCALE
+
+    work_pay = np.where(is_ft, 0, half_up_div(to_qty_units(df_in['總工時']) * rate_num, rate_den * q))
+    ot_pay = half_up_div(to_qty_units(df_in['加班時數']) * rate_num, rate_den * q)
+    penalty_mins = np.asarray(df_in['遲到早退分鐘'], dtype=np.int64).astype(object)
+    time_deduction = np.where(is_ft, half_up_div(penalty_mins * rate_num, rate_den * 60), 0)
+
+    sh_q = to_qty_units(df_in['特殊節日時數'])
+    special = half_up_div(sh_q * rate_num * 3, rate_den * q * 2)
+    special = np.where((sh_q > 0) & (special > 0), special, 0)
+
+    rewards = []
+    for j in range(n_reward_pairs):
+        h_q = to_qty_units(df_in[f'時數獎勵{j}_時數'])
+        m_q = to_qty_units(df_in[f'時數獎勵{j}_倍數'])
+        val = half_up_div(h_q * m_q * rate_num, rate_den * q * q)
+        rewards.append(np.where((h_q > 0) & (val > 0), val, 0))
+
+    hour_bonus = special + sum(rewards) if rewards else special
+    bonus_total = df_in['加項分'].to_numpy(dtype=object) + hour_bonus
+    gross = np.where(is_ft, base_c + ot_pay + bonus_total - time_deduction, work_pay + ot_pay + bonus_total)
+    ins = df_in['勞保分'].to_numpy(dtype=object) + df_in['健保分'].to_numpy(dtype=object)
+    net = gross - df_in['扣項分'].to_numpy(dtype=object) - ins
+
+    return {
+        "精算時薪": half_up_div(rate_num, rate_den),
+        "本薪/PT基礎薪": np.where(is_ft, base_c, work_pay),
+        "加班加給": ot_pay,
+        "出勤扣款": time_deduction,
+        "特殊節日": special,
+        "時數獎勵": rewards,
+        "特殊節日加成金額": hour_bonus,
+        "各項獎金與津貼總計": bonus_total,
+        "各項扣款總計": df_in['扣項分'].to_numpy(dtype=object),
+        "應發薪資(毛額)": gross,
+        "勞健保扣款": np.where(ins > 0, -ins, 0),
+        "本月實領薪資": half_up_div(net, 100)
+    }
+
+MONEY_RECONCILE_FIELDS = ["精算時薪", "本薪/PT基礎薪", "加班加給", "出勤扣款", "特殊節日加成金額", "各項獎金與津貼總計", "各項扣款總計", "應發薪資(毛額)", "本月實領薪資"]
+
+def generate_final_payslip(df_calc, df_fixed, df_var, dynamic_bonus_cols, dynamic_fixed_cols, df_hr_reward, hr_reward_pairs, emp_master=None, money_report=None):
+    if df_calc.empty:
         return []
-        
+
+    if emp_master is None or '員工ID' not in df_calc.columns:
+        # 未沿用第一階段主檔時，員工 ID 須以本次主檔重新對應
+        if emp_master is None:
+            emp_master = build_employee_master({"出勤結算": df_calc['員工']})
+        df_calc = attach_employee_ids(df_calc.copy(), emp_master, '員工')
+    register_employee_names(emp_master, "固定參數", df_fixed['員工姓名'] if '員工姓名' in df_fixed.columns else [])
+    register_employee_names(emp_master, "本月浮動獎金", df_var['員工姓名'] if '員工姓名' in df_var.columns else [])
+    if not df_hr_reward.empty and '員工姓名' in df_hr_reward.columns:
+        register_employee_names(emp_master, "時數獎勵", df_hr_reward['員工姓名'])
+
+    summary = df_calc.groupby('員工ID').agg({
+        '員工': 'first',
+        '遲到(分)': 'sum',
+        '早退(分)': 'sum',
+        '加班(時)': 'sum',
+        '總工時(時)': 'sum',
+        '身份': 'first'
+    }).reset_index().sort_values('員工', kind='stable')
+
+    fixed_rows = index_rows_by_employee(df_fixed, emp_master)
+    var_rows = index_rows_by_employee(df_var, emp_master)
+    hr_rows = index_rows_by_employee(df_hr_reward, emp_master)
+
+    # 所有動態加扣項整欄一次轉為整數分
+    fixed_cents = to_cents(df_fixed[dynamic_fixed_cols].to_numpy(dtype=float)) if dynamic_fixed_cols and not df_fixed.empty else None
+    var_cents = to_cents(df_var[dynamic_bonus_cols].to_numpy(dtype=float)) if dynamic_bonus_cols and not df_var.empty else None
+
     payslip_data = []
-    
+    money_inputs = []
+    bonus_slots = []
+
     for _, emp_data in summary.iterrows():
+        emp_id = emp_data['員工ID']
         emp_name = emp_data['員工']
         emp_type = emp_data['身份']
-        
-        fixed_record = df_fixed[df_fixed['員工姓名'] == emp_name] if not df_fixed.empty and '員工姓名' in df_fixed.columns else pd.DataFrame()
-        var_record = df_var[df_var['員工姓名'] == emp_name] if not df_var.empty and '員工姓名' in df_var.columns else pd.DataFrame()
-        hr_record = df_hr_reward[df_hr_reward['員工姓名'] == emp_name] if not df_hr_reward.empty and '員工姓名' in df_hr_reward.columns else pd.DataFrame()
-        
+
+        fixed_record = df_fixed.iloc[[fixed_rows[emp_id]]] if emp_id in fixed_rows else pd.DataFrame()
+        var_record = df_var.iloc[[var_rows[emp_id]]] if emp_id in var_rows else pd.DataFrame()
+        hr_record = df_hr_reward.iloc[[hr_rows[emp_id]]] if emp_id in hr_rows else pd.DataFrame()
+
         base_salary_or_hourly = float(fixed_record['本薪或時薪'].values[0]) if not fixed_record.empty and pd.notna(fixed_record['本薪或時薪'].values[0]) else 0.0
         exact_hourly_rate = float(base_salary_or_hourly / 240.0) if emp_type == "正職" and base_salary_or_hourly > 0 else float(base_salary_or_hourly)
         
@@ -577,30 +835,53 @@ def generate_final_payslip(df_calc, df_fixed, df_var, dynamic_bonus_cols, dynami
         total_variable_bonus = 0.0
         special_holiday_bonus = 0.0
         total_other_deductions = 0.0
-        
+        money_in = {
+            "身份": emp_type, "本薪或時薪": base_salary_or_hourly,
+            "總工時": emp_data['總工時(時)'], "加班時數": emp_data['加班(時)'],
+            "遲到早退分鐘": emp_data['遲到(分)'] + emp_data['早退(分)'] if emp_type != "PT" else 0,
+            "加項分": 0, "扣項分": 0, "勞保分": int(to_cents([labor_ins])[0]), "健保分": int(to_cents([health_ins])[0]),
+            "特殊節日時數": 0.0
+        }
+        for j in range(len(hr_reward_pairs)):
+            money_in[f'時數獎勵{j}_時數'] = 0.0
+            money_in[f'時數獎勵{j}_倍數'] = 1.0
+        slots = []
+
+        for cents_row in ([fixed_cents[fixed_rows[emp_id]]] if fixed_cents is not None and emp_id in fixed_rows else []) + \
+                         ([var_cents[var_rows[emp_id]]] if var_cents is not None and emp_id in var_rows else []):
+            money_in["加項分"] += sum(c for c in cents_row if c > 0)
+            money_in["扣項分"] += sum(-c for c in cents_row if c < 0)
+
+        # 明細顯示整數分換算的金額，與加項分、扣項分合計一致；浮點合計僅供比對報表
         if not fixed_record.empty:
-            for col in dynamic_fixed_cols:
+            for col, cents in zip(dynamic_fixed_cols, fixed_cents[fixed_rows[emp_id]] if fixed_cents is not None else []):
                 val = float(fixed_record[col].values[0])
                 if val > 0:
-                    earned_bonuses[col] = val
                     total_variable_bonus += val
                 elif val < 0:
-                    deductions[col] = abs(val)
                     total_other_deductions += abs(val)
+                if cents > 0:
+                    earned_bonuses[col] = cents / 100
+                elif cents < 0:
+                    deductions[col] = -cents / 100
 
         if not var_record.empty:
-            for col in dynamic_bonus_cols:
+            for col, cents in zip(dynamic_bonus_cols, var_cents[var_rows[emp_id]] if var_cents is not None else []):
                 val = float(var_record[col].values[0])
                 if val > 0:
-                    earned_bonuses[col] = val
                     total_variable_bonus += val
                 elif val < 0:
-                    deductions[col] = abs(val)
                     total_other_deductions += abs(val)
+                if cents > 0:
+                    earned_bonuses[col] = cents / 100
+                elif cents < 0:
+                    deductions[col] = -cents / 100
                     
             if '特殊節日加給(時數)' in var_record.columns:
                 sh_hours = float(var_record['特殊節日加給(時數)'].values[0])
+                money_in["特殊節日時數"] = sh_hours
                 if sh_hours > 0:
+                    slots.append(('特殊節日加成(1.5倍)', None))
                     special_val = custom_round_2(exact_hourly_rate * sh_hours * 1.5)
                     if special_val > 0:
                         earned_bonuses['特殊節日加成(1.5倍)'] = special_val
@@ -608,10 +889,13 @@ def generate_final_payslip(df_calc, df_fixed, df_var, dynamic_bonus_cols, dynami
                         special_holiday_bonus += special_val
 
         if not hr_record.empty:
-            for hr_col, mult_col, base_name in hr_reward_pairs:
+            for j, (hr_col, mult_col, base_name) in enumerate(hr_reward_pairs):
                 h_val = float(hr_record[hr_col].values[0])
                 m_val = float(hr_record[mult_col].values[0])
+                money_in[f'時數獎勵{j}_時數'] = h_val
+                money_in[f'時數獎勵{j}_倍數'] = m_val
                 if h_val > 0:
+                    slots.append((f"{base_name}({m_val}倍)" if m_val != 1.0 else base_name, j))
                     calculated_val = custom_round_2(exact_hourly_rate * h_val * m_val)
                     if calculated_val > 0:
                         display_name = f"{base_name}({m_val}倍)" if m_val != 1.0 else base_name
@@ -654,40 +938,150 @@ def generate_final_payslip(df_calc, df_fixed, df_var, dynamic_bonus_cols, dynami
             "本月實領薪資": custom_round(net_pay)
         }
         payslip_data.append(record)
-        
+        money_inputs.append(money_in)
+        bonus_slots.append(slots)
+
+    # 以整數分結果為準覆寫金額欄位，並列出與浮點運算結果不一致的員工
+    money = compute_payslip_money_cents(pd.DataFrame(money_inputs), len(hr_reward_pairs))
+    for i, record in enumerate(payslip_data):
+        float_vals = {f: record[f] for f in MONEY_RECONCILE_FIELDS}
+        for name, j in bonus_slots[i]:
+            cents = money["特殊節日"][i] if j is None else money["時數獎勵"][j][i]
+            if cents > 0:
+                record["動態加項明細"][name] = cents / 100
+            else:
+                record["動態加項明細"].pop(name, None)
+        for f in MONEY_RECONCILE_FIELDS:
+            if f == "本月實領薪資":
+                record[f] = int(money[f][i])
+            else:
+                record[f] = money[f][i] / 100
+        record["勞健保扣款"] = money["勞健保扣款"][i] / 100
+        if money_report is not None:
+            for f in MONEY_RECONCILE_FIELDS:
+                float_c = int(float_vals[f]) * 100 if f == "本月實領薪資" else int(np.rint(float_vals[f] * 100))
+                cents_c = int(money[f][i]) * 100 if f == "本月實領薪資" else int(money[f][i])
+                if float_c != cents_c:
+                    money_report.append({"員工姓名": record["員工姓名"], "項目": f, "浮點運算結果": float_vals[f], "整數分結果": cents_c / 100})
+
     return payslip_data
 
 # ==========================================
 # 模組五：會計統計總表產生器
 # ==========================================
-def generate_accounting_excel(payslip_records, revenue):
+XLSX_MAX_ROWS = 1048576
+
+# 欄位格式只定義一次，串流寫入時由欄格式套用至整欄，不逐格建立格式物件
+ACCOUNTING_COLUMN_FORMATS = {
+    "header": {"bold": True, "border": 1, "align": "center", "valign": "top"},
+    "money": {"num_format": "#,##0.00"},
+    "hours": {"num_format": "0.00"},
+    "datetime": {"num_format": "yyyy-mm-dd hh:mm"},
+    "text": {},
+}
+
+ACCOUNTING_COLUMN_KINDS = {
+    "精算時薪": "money", "本薪/PT基礎薪": "money", "加班加給": "money", "特殊節日加成金額": "money",
+    "出勤扣款": "money", "各項獎金與津貼總計": "money", "各項扣款總計": "money",
+    "應發薪資(毛額)": "money", "勞健保扣款": "money", "本月實領薪資": "money",
+    "總工時": "hours", "加班時數": "hours", "加班(時)": "hours", "總工時(時)": "hours",
+    "上班時間": "datetime", "下班時間": "datetime", "打卡時間": "datetime",
+}
+
+def _xlsx_cell_value(val):
+    if val is None:
+        return None
+    if isinstance(val, (dict, list)):
+        return str(val)
+    try:
+        if pd.isna(val):
+            return None
+    except (TypeError, ValueError):
+        return str(val)
+    if isinstance(val, pd.Timestamp):
+        return val.to_pydatetime()
+    if hasattr(val, 'item'):
+        return val.item()
+    return val
+
+def write_streaming_sheet(workbook, sheet_name, columns, rows, formats, widths=None):
+    """以 constant_memory 列串流寫入單一工作表，超過 Excel 列數上限時自動續頁。"""
+    widths = widths or {}
+    page = 1
+    worksheet = None
+    row_idx = XLSX_MAX_ROWS
+
+    for row in rows:
+        if row_idx >= XLSX_MAX_ROWS:
+            name = sheet_name if page == 1 else f"{sheet_name}({page})"
+            worksheet = workbook.add_worksheet(name[:31])
+            for c, col in enumerate(columns):
+                kind = ACCOUNTING_COLUMN_KINDS.get(col, "text")
+                worksheet.set_column(c, c, widths.get(col, 14), formats[kind])
+            worksheet.write_row(0, 0, columns, formats["header"])
+            row_idx = 1
+            page += 1
+        for c, val in enumerate(row):
+            val = _xlsx_cell_value(val)
+            if val is None:
+                continue
+            if isinstance(val, datetime):
+                worksheet.write_datetime(row_idx, c, val, formats[ACCOUNTING_COLUMN_KINDS.get(columns[c], "datetime")])
+            else:
+                worksheet.write(row_idx, c, val)
+        row_idx += 1
+
+    if worksheet is None:
+        worksheet = workbook.add_worksheet(sheet_name[:31])
+        worksheet.write_row(0, 0, columns, formats["header"])
+
+def write_accounting_workbook(output, payslip_records, revenue, df_daily=None, df_audit=None):
+    """將會計統計、員工薪資明細、每日出勤明細與覆寫稽核寫入同一活頁簿。
+
+    output 可為檔案路徑或 BytesIO；所有工作表皆以列迭代器逐列寫出，
+    搭配 xlsxwriter 的 constant_memory 模式，整年度多店資料亦不需整本留在記憶體。
+    """
     df = pd.DataFrame(payslip_records)
-    if df.empty: return io.BytesIO().getvalue()
-    
+    if df.empty:
+        return False
+
     ft_total = df[df['身份'] == '正職']['應發薪資(毛額)'].sum()
     pt_total = df[df['身份'] == 'PT']['應發薪資(毛額)'].sum()
     ot_total = df['加班加給'].sum()
     bonus_total = df['各項獎金與津貼總計'].sum()
-    
+
     total_cost = ft_total + pt_total
     cost_ratio = f"{(total_cost / revenue * 100):.2f}%" if revenue > 0 else "0%"
-    
-    summary_data = {
-        "統計項目": ["本月營業總額", "總人事成本 (正職+兼職)", "人事成本佔比", "正職薪資合計 (含獎金加班)", "兼職(PT)薪資合計 (含獎金)", "全體加班費合計", "全體各項獎金合計"],
-        "金額 / 數據": [f"{int(revenue):,}", fmt(total_cost), cost_ratio, fmt(ft_total), fmt(pt_total), fmt(ot_total), fmt(bonus_total)]
-    }
-    df_summary = pd.DataFrame(summary_data)
+
+    summary_rows = zip(
+        ["本月營業總額", "總人事成本 (正職+兼職)", "人事成本佔比", "正職薪資合計 (含獎金加班)", "兼職(PT)薪資合計 (含獎金)", "全體加班費合計", "全體各項獎金合計"],
+        [f"{int(revenue):,}", fmt(total_cost), cost_ratio, fmt(ft_total), fmt(pt_total), fmt(ot_total), fmt(bonus_total)]
+    )
     df_detailed = df.drop(columns=['動態加項明細', '動態扣項明細'])
-    
+
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    formats = {kind: workbook.add_format(props) for kind, props in ACCOUNTING_COLUMN_FORMATS.items()}
+    try:
+        write_streaming_sheet(workbook, '會計統計報表', ["統計項目", "金額 / 數據"], summary_rows, formats,
+                              widths={"統計項目": 30, "金額 / 數據": 20})
+        write_streaming_sheet(workbook, '員工薪資明細', list(df_detailed.columns),
+                              df_detailed.itertuples(index=False, name=None), formats)
+        if df_daily is not None and not df_daily.empty:
+            # 員工 ID 僅供內部對接主檔，不輸出至報表
+            df_daily = df_daily.drop(columns=['員工ID'], errors='ignore')
+            write_streaming_sheet(workbook, '每日出勤明細', list(df_daily.columns),
+                                  df_daily.itertuples(index=False, name=None), formats, widths={"狀態": 22})
+        if df_audit is not None and not df_audit.empty:
+            write_streaming_sheet(workbook, '異常覆寫稽核', list(df_audit.columns),
+                                  df_audit.itertuples(index=False, name=None), formats, widths={"幹部備註原因": 60})
+    finally:
+        workbook.close()
+    return True
+
+def generate_accounting_excel(payslip_records, revenue, df_daily=None, df_audit=None):
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df_summary.to_excel(writer, sheet_name='會計統計報表', index=False)
-        df_detailed.to_excel(writer, sheet_name='員工薪資明細', index=False)
-        
-        worksheet1 = writer.sheets['會計統計報表']
-        worksheet1.set_column('A:A', 30)
-        worksheet1.set_column('B:B', 20)
-        
+    if not write_accounting_workbook(output, payslip_records, revenue, df_daily, df_audit):
+        return io.BytesIO().getvalue()
     return output.getvalue()
 
 # ==========================================
@@ -712,8 +1106,10 @@ def split_text_into_lines(text, max_chars_per_line=22):
         lines.append(text)
     return lines
 
+PAYSLIP_FONT_PATH = "NotoSansTC-Regular.ttf"
+
 def create_payslip_image(record, month_str, custom_msg):
-    font_path = "NotoSansTC-Regular.ttf"
+    font_path = PAYSLIP_FONT_PATH
     try:
         font = ImageFont.truetype(font_path, 20)
         font_title = ImageFont.truetype(font_path, 26)
@@ -834,135 +1230,440 @@ def create_payslip_image(record, month_str, custom_msg):
     img.save(img_byte_arr, format='JPEG', quality=95)
     return img_byte_arr.getvalue()
 
-def create_zip_archive_images(payslips, month_str, custom_msg):
+# ==========================================
+# 薪資圖檔快取：以紀錄雜湊判斷是否需重繪
+# ==========================================
+PAYSLIP_CACHE_MAX_BYTES = 128 * 1024 * 1024
+PAYSLIP_RENDER_WORKERS = 4
+
+def new_payslip_render_cache(max_bytes=PAYSLIP_CACHE_MAX_BYTES):
+    return {"items": OrderedDict(), "bytes": 0, "max_bytes": max_bytes, "lock": threading.Lock()}
+
+def font_fingerprint(font_path=PAYSLIP_FONT_PATH):
+    # 字體檔更換後，所有圖檔都必須重繪
+    try:
+        st_font = os.stat(font_path)
+        return f"{font_path}:{st_font.st_size}:{int(st_font.st_mtime)}"
+    except OSError:
+        return "default"
+
+def payslip_cache_key(record, month_str, custom_msg, font_id=None):
+    payload = json.dumps(record, sort_keys=True, ensure_ascii=False, default=str)
+    h = hashlib.sha256()
+    for part in (payload, str(month_str), custom_msg or "", font_id or font_fingerprint()):
+        h.update(part.encode('utf-8'))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+def payslip_cache_get(cache, key):
+    with cache["lock"]:
+        img_bytes = cache["items"].get(key)
+        if img_bytes is not None:
+            cache["items"].move_to_end(key)
+        return img_bytes
+
+def payslip_cache_put(cache, key, img_bytes):
+    with cache["lock"]:
+        if key in cache["items"]:
+            cache["bytes"] -= len(cache["items"].pop(key))
+        if len(img_bytes) > cache["max_bytes"]:
+            return
+        cache["items"][key] = img_bytes
+        cache["bytes"] += len(img_bytes)
+        # 超過容量上限時，自最久未使用者開始淘汰
+        while cache["bytes"] > cache["max_bytes"]:
+            _, evicted = cache["items"].popitem(last=False)
+            cache["bytes"] -= len(evicted)
+
+def render_payslip_cached(record, month_str, custom_msg, cache=None, font_id=None):
+    """回傳 (圖檔位元組, 是否沿用快取)。"""
+    if cache is None:
+        return create_payslip_image(record, month_str, custom_msg), False
+    key = payslip_cache_key(record, month_str, custom_msg, font_id)
+    img_bytes = payslip_cache_get(cache, key)
+    if img_bytes is not None:
+        return img_bytes, True
+    img_bytes = create_payslip_image(record, month_str, custom_msg)
+    payslip_cache_put(cache, key, img_bytes)
+    return img_bytes, False
+
+def create_zip_archive_images(payslips, month_str, custom_msg, cache=None, stats=None, workers=PAYSLIP_RENDER_WORKERS):
     zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-        for p in payslips:
-            img_bytes = create_payslip_image(p, month_str, custom_msg)
+    rendered, reused = 0, 0
+    font_id = font_fingerprint()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool, zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        futures = [pool.submit(render_payslip_cached, p, month_str, custom_msg, cache, font_id) for p in payslips]
+        # 依員工順序寫入壓縮檔：前一張壓縮的同時，後續圖檔仍在繪製
+        for p, fut in zip(payslips, futures):
+            img_bytes, hit = fut.result()
+            if hit:
+                reused += 1
+            else:
+                rendered += 1
             zip_file.writestr(f"{p['員工姓名']}_{month_str}薪資單.jpg", img_bytes)
+    if stats is not None:
+        stats.update({"rendered": rendered, "reused": reused})
     return zip_buffer.getvalue()
 
+# ==========================================
+# 流程排程：依步驟相依關係並行執行，並記錄關鍵路徑
+# ==========================================
+TASK_GRAPH_WORKERS = 4
+
+class StageInputError(ValueError):
+    """輸入檔解析失敗，訊息直接顯示給使用者。"""
+
+def unwrap_step_result(result):
+    # 解析函式回傳 (..., 錯誤訊息)；有錯誤時中止後續步驟
+    *values, error_msg = result
+    if error_msg:
+        raise StageInputError(error_msg)
+    return values[0] if len(values) == 1 else tuple(values)
+
+def _run_timed_step(fn, args, origin):
+    start = time.perf_counter() - origin
+    value = fn(*args)
+    return value, start, time.perf_counter() - origin
+
+def run_task_graph(steps, max_workers=TASK_GRAPH_WORKERS):
+    """steps 為 {步驟名稱: (函式, [相依步驟])}，函式依序接收相依步驟的結果。回傳 (各步驟結果, 執行摘要)。
+
+    相依步驟皆完成者立即送入執行緒池；任一步驟失敗即不再啟動新步驟，待執行中者結束後拋出原例外。
+    """
+    unknown = sorted({d for _, deps in steps.values() for d in deps if d not in steps})
+    if unknown:
+        raise ValueError(f"未定義的相依步驟：{'、'.join(unknown)}")
+    results, spans = {}, {}
+    pending = dict(steps)
+    origin = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        running = {}
+        while pending or running:
+            for name in [n for n, (_, deps) in pending.items() if all(d in results for d in deps)]:
+                fn, deps = pending.pop(name)
+                running[pool.submit(_run_timed_step, fn, [results[d] for d in deps], origin)] = name
+            if not running:
+                raise ValueError(f"步驟相依關係成環：{'、'.join(pending)}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                name = running.pop(fut)
+                results[name], start, end = fut.result()
+                spans[name] = (start, end)
+    return results, task_graph_summary(steps, spans)
+
+def task_graph_summary(steps, spans):
+    # 各步驟的關鍵路徑：沿最晚完成的相依步驟回溯，即實際決定該步驟何時能開始的前置鏈
+    chains = {}
+    def chain(name):
+        if name not in chains:
+            deps = steps[name][1]
+            chains[name] = (chain(max(deps, key=lambda d: spans[d][1])) if deps else []) + [name]
+        return chains[name]
+
+    rows = []
+    for name, (start, end) in sorted(spans.items(), key=lambda kv: kv[1][0]):
+        rows.append({
+            "步驟": name, "相依": "、".join(steps[name][1]),
+            "開始(秒)": round(start, 3), "耗時(秒)": round(end - start, 3), "完成(秒)": round(end, 3),
+            "關鍵路徑": " → ".join(chain(name))
+        })
+    last = max(spans, key=lambda n: spans[n][1]) if spans else None
+    path = chain(last) if last else []
+    return {
+        "steps": pd.DataFrame(rows), "critical_path": path,
+        "critical_seconds": sum(spans[n][1] - spans[n][0] for n in path),
+        "wall_seconds": spans[last][1] if last else 0.0
+    }
+
 # ==========================================
 # 介面渲染：兩階段防禦性解耦架構 (Session State 保護)
 # ==========================================
-st.set_page_config(page_title="IKKON 薪資自動化結算系統", layout="wide")
-st.title("IKKON 薪資自動化結算系統")
-
-if not os.path.exists("NotoSansTC-Regular.ttf"):
-    st.error("系統警告：尚未偵測到中文字體檔 (NotoSansTC-Regular.ttf)。請將該檔案上傳至 GitHub，否則產出的薪資圖檔將會顯示為亂碼。")
-
-if 'df_final_calc' not in st.session_state:
-    st.session_state.df_final_calc = pd.DataFrame()
-if 'stage2_done' not in st.session_state:
-    st.session_state.stage2_done = False
-if 'zip_data' not in st.session_state:
-    st.session_state.zip_data = None
-if 'excel_data' not in st.session_state:
-    st.session_state.excel_data = None
-
-st.markdown("---")
-st.markdown("### 階段一：出缺勤診斷與異常覆寫")
-
-col1, col2, col3 = st.columns(3)
-with col1:
-    ichef_file = st.file_uploader("1. 上傳 iCHEF 打卡紀錄", type=["xlsx"], key="ichef")
-with col2:
-    roster_file = st.file_uploader("2. 上傳 店鋪當月班表", type=["xlsx"], key="roster")
-    selected_sheet = None
-    if roster_file:
-        try:
-            xls = pd.ExcelFile(roster_file)
-            sheet_names = xls.sheet_names
-            selected_sheet = st.selectbox("請選擇班表月份 (工作表)：", sheet_names)
-        except Exception as e:
-            st.error("讀取班表失敗。")
-with col3:
-    anomaly_file = st.file_uploader("3. 上傳 7欄位異常表 (若無可略過)", type=["csv", "xlsx"], key="anomaly")
-    anomaly_selected_sheet = None
-    if anomaly_file and anomaly_file.name.endswith('.xlsx'):
-        try:
-            xls_anomaly = pd.ExcelFile(anomaly_file)
-            anomaly_sheet_names = xls_anomaly.sheet_names
-            anomaly_selected_sheet = st.selectbox("請選擇異常表月份 (工作表)：", anomaly_sheet_names)
-        except Exception as e:
-            st.error("讀取異常表分頁失敗。")
-
-if ichef_file and roster_file and selected_sheet:
-    if st.button("執行第一階段：出缺勤試算"):
-        with st.spinner('進行時間碰撞與異常診斷中...'):
-            df_cleaned, df_error = clean_ichef_data(ichef_file)
-            df_roster, error_msg = parse_roster_data(roster_file, selected_sheet)
-            
-            if error_msg:
-                st.error(error_msg)
-            else:
-                df_anomaly = parse_standard_anomaly_data(anomaly_file, anomaly_selected_sheet)
-                df_final_calc, df_audit = calculate_payroll_hours(df_roster, df_cleaned, df_anomaly)
-                
-                st.session_state.df_final_calc = df_final_calc
-                st.session_state.stage2_done = False
-                st.session_state.zip_data = None
-                st.session_state.excel_data = None
+@st.cache_resource
+def get_artifact_store():
+    # 同一伺服器行程內所有 session 共用，相同輸入只保留一份結果
+    return new_artifact_store()
+
+@st.cache_resource
+def get_payslip_render_cache():
+    # 跨 rerun 與跨 session 共用，修正單一員工後重跑只需重繪該員工
+    return new_payslip_render_cache()
+
+def render_run_summary(summary):
+    with st.expander(f"執行摘要：總耗時 {summary['wall_seconds']:.2f} 秒，關鍵路徑 {summary['critical_seconds']:.2f} 秒"):
+        st.caption("關鍵路徑：" + " → ".join(summary["critical_path"]))
+        st.dataframe(summary["steps"])
+
+def main():
+    st.set_page_config(page_title="IKKON 薪資自動化結算系統", layout="wide")
+    st.title("IKKON 薪資自動化結算系統")
+
+    if not os.path.exists(PAYSLIP_FONT_PATH):
+        st.error("系統警告：尚未偵測到中文字體檔 (NotoSansTC-Regular.ttf)。請將該檔案上傳至 GitHub，否則產出的薪資圖檔將會顯示為亂碼。")
+
+    # Session 只保存產出物鍵值，實際資料集中存放於全站倉儲
+    artifact_store = get_artifact_store()
+    if 'stage1_key' not in st.session_state:
+        st.session_state.stage1_key = None
+    if 'stage2_key' not in st.session_state:
+        st.session_state.stage2_key = None
+
+    st.markdown("---")
+    st.markdown("### 階段一：出缺勤診斷與異常覆寫")
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        ichef_file = st.file_uploader("1. 上傳 iCHEF 打卡紀錄", type=["xlsx"], key="ichef")
+    with col2:
+        roster_file = st.file_uploader("2. 上傳 店鋪當月班表", type=["xlsx"], key="roster")
+        selected_sheet = None
+        if roster_file:
+            try:
+                xls = pd.ExcelFile(roster_file)
+                sheet_names = xls.sheet_names
+                selected_sheet = st.selectbox("請選擇班表月份 (工作表)：", sheet_names)
+            except Exception as e:
+                st.error("讀取班表失敗。")
+    with col3:
+        anomaly_file = st.file_uploader("3. 上傳 7欄位異常表 (若無可略過)", type=["csv", "xlsx"], key="anomaly")
+        shift_rules_file = st.file_uploader("店鋪班別規則檔 (JSON，若無則使用預設規則)", type=["json"], key="shift_rules")
+        anomaly_selected_sheet = None
+        if anomaly_file and anomaly_file.name.endswith('.xlsx'):
+            try:
+                xls_anomaly = pd.ExcelFile(anomaly_file)
+                anomaly_sheet_names = xls_anomaly.sheet_names
+                anomaly_selected_sheet = st.selectbox("請選擇異常表月份 (工作表)：", anomaly_sheet_names)
+            except Exception as e:
+                st.error("讀取異常表分頁失敗。")
+
+    opt_col1, opt_col2 = st.columns(2)
+    with opt_col1:
+        chunked_mode = st.checkbox("大型打卡匯出檔分段處理模式 (依員工分批清洗與結算，降低記憶體用量)", value=False)
+        delta_mode = st.checkbox("累加合併模式 (與先前匯入的同店打卡紀錄去重合併，只重新清洗新涵蓋的日期)", value=False)
+        store_id = st.text_input("店鋪代號 (各店打卡紀錄依代號分開保存)：", value="") if delta_mode else None
+    with opt_col2:
+        calc_workers = st.number_input("平行結算行程數 (1 為單一行程)：", min_value=1, max_value=os.cpu_count() or 1, value=1, step=1)
+
+    if ichef_file and roster_file and selected_sheet:
+        if delta_mode and not store_id.strip():
+            st.warning("累加合併模式需先填寫店鋪代號。")
+        elif st.button("執行第一階段：出缺勤試算"):
+            with st.spinner('進行時間碰撞與異常診斷中...'):
+                ichef_version = ichef_file.getvalue()
+                if delta_mode:
+                    # 合併後的店鋪紀錄才是本次試算的輸入，快取鍵改以紀錄版本計算
+                    df_cleaned, df_error, merge_stats = ingest_ichef_export(store_id, ichef_file)
+                    ichef_version = merge_stats["版本"]
+                    redo_dates = sorted(d for d in merge_stats["重新清洗"].values() if d is not None)
+                    st.caption(f"打卡紀錄合併：新增 {merge_stats['新事件']} 筆、略過重複 {merge_stats['重複事件']} 筆；"
+                               f"重新清洗 {len(merge_stats['重新清洗'])} 位員工" + (f"，最早自 {redo_dates[0]} 起。" if redo_dates else "。"))
+                stage1_key = artifact_key("stage1", ichef_version, roster_file.getvalue(), selected_sheet,
+                                          anomaly_file.getvalue() if anomaly_file else b"", anomaly_selected_sheet,
+                                          shift_rules_file.getvalue() if shift_rules_file else b"")
+                stage1 = artifact_store_get(artifact_store, stage1_key)
+                error_msg = ""
+                run_summary = None
+                if stage1 is None:
+                    use_chunked = chunked_mode and not delta_mode
+                    punch_deps = [] if use_chunked else ["解析打卡紀錄"]
+
+                    def build_master(df_roster, df_anomaly, punches=None):
+                        sources = {"班表": df_roster['員工']}
+                        if punches is not None:
+                            sources["iCHEF打卡"] = punches[0]['員工'] if not punches[0].empty else []
+                        sources["異常表"] = df_anomaly['員工'] if not df_anomaly.empty else []
+                        return build_employee_master(sources)
+
+                    def calculate(df_roster, df_anomaly, shift_rules, emp_master, punches=None):
+                        if punches is None:
+                            return calculate_payroll_hours_chunked(df_roster, ichef_file, df_anomaly, emp_master, shift_rules)
+                        df_cleaned, df_error = punches
+                        if calc_workers > 1:
+                            df_calc, df_aud = calculate_payroll_hours_parallel(df_roster, df_cleaned, df_anomaly, emp_master, int(calc_workers), shift_rules)
+                        else:
+                            df_calc, df_aud = calculate_payroll_hours(df_roster, df_cleaned, df_anomaly, emp_master, shift_rules)
+                        return df_calc, df_aud, df_error
+
+                    # 打卡、異常表與規則檔互不相依，同時解析；班表需依規則檔辨識班別名稱，主檔與結算待所需輸入完成後接續執行
+                    steps = {
+                        "解析班表": (lambda shift_rules: unwrap_step_result(parse_roster_data(roster_file, selected_sheet, shift_rules)), ["載入班別規則"]),
+                        "解析異常表": (lambda: parse_standard_anomaly_data(anomaly_file, anomaly_selected_sheet), []),
+                        "載入班別規則": (lambda: unwrap_step_result(load_shift_rules(shift_rules_file)) if shift_rules_file else None, []),
+                        "建立員工主檔": (build_master, ["解析班表", "解析異常表"] + punch_deps),
+                        "工時結算": (calculate, ["解析班表", "解析異常表", "載入班別規則", "建立員工主檔"] + punch_deps),
+                        # 分段模式於結算途中才登錄打卡姓名，比對需待結算完成
+                        "員工姓名比對": (lambda emp_master, _: employee_mismatch_report(emp_master, ["班表", "iCHEF打卡"]), ["建立員工主檔", "工時結算"])
+                    }
+                    if delta_mode:
+                        # 店鋪紀錄涵蓋歷來所有匯出檔，只取本次班表月份 (含前後一天) 進入結算
+                        log_sessions, log_errors = df_cleaned, df_error
+                        steps["解析打卡紀錄"] = (lambda df_roster: trim_punch_log_to_roster(log_sessions, log_errors, df_roster), ["解析班表"])
+                    elif not use_chunked:
+                        steps["解析打卡紀錄"] = (lambda: clean_ichef_data(ichef_file), [])
+
+                    try:
+                        results, run_summary = run_task_graph(steps)
+                    except StageInputError as e:
+                        error_msg = str(e)
+                    if not error_msg:
+                        df_final_calc, df_audit, df_error = results["工時結算"]
+                        stage1 = artifact_store_put(artifact_store, stage1_key, {
+                            "df_final_calc": df_final_calc, "df_audit": df_audit, "df_error": df_error,
+                            "df_mismatch": results["員工姓名比對"], "emp_master": results["建立員工主檔"]
+                        })
+
+                if error_msg:
+                    st.error(error_msg)
+                elif run_summary is None:
+                    st.info("已有相同輸入的試算結果，直接沿用。")
+
+                if stage1 is not None:
+                    st.session_state.stage1_key = stage1_key
+                    st.session_state.stage2_key = None
+                    df_final_calc, df_audit, df_error, df_mismatch = stage1["df_final_calc"], stage1["df_audit"], stage1["df_error"], stage1["df_mismatch"]
                 
-                st.success("第一階段運算完成。請於下方報表查閱異常攔截紀錄與每日出缺勤明細。")
+                    st.success("第一階段運算完成。請於下方報表查閱異常攔截紀錄與每日出缺勤明細。")
+                    if run_summary is not None:
+                        render_run_summary(run_summary)
                 
-                tab_main, tab_audit, tab_error = st.tabs([
-                    "每日出缺勤明細 (試算結果)", "異常表覆寫稽核", "原始打卡異常攔截 (需人工查核)"
-                ])
+                    tab_main, tab_audit, tab_error, tab_names = st.tabs([
+                        "每日出缺勤明細 (試算結果)", "異常表覆寫稽核", "原始打卡異常攔截 (需人工查核)", "員工姓名比對"
+                    ])
                 
-                with tab_main: 
-                    st.dataframe(df_final_calc)
-                with tab_audit: 
-                    if not df_audit.empty: st.dataframe(df_audit)
-                    else: st.info("本次無覆寫紀錄。")
-                with tab_error: 
-                    if not df_error.empty: st.dataframe(df_error)
-                    else: st.write("無異常紀錄。")
-
-st.markdown("---")
-st.markdown("### 階段二：圖形化薪資單產出與會計報表")
-
-col_a, col_b = st.columns(2)
-with col_a:
-    st.markdown("##### 1. 會計核算參數")
-    revenue_input = st.number_input("請輸入本月營業總額 (供計算人事成本佔比)：", min_value=0, value=0, step=1000)
-    salary_param_file = st.file_uploader("4. 上傳 薪資與獎金設定表 (支援無限欄位擴充)", type=["xlsx"], key="salary")
+                    with tab_main: 
+                        st.dataframe(df_final_calc.drop(columns=['員工ID'], errors='ignore'))
+                    with tab_audit: 
+                        if not df_audit.empty: st.dataframe(df_audit)
+                        else: st.info("本次無覆寫紀錄。")
+                    with tab_error: 
+                        if not df_error.empty: st.dataframe(df_error)
+                        else: st.write("無異常紀錄。")
+                    with tab_names:
+                        if not df_mismatch.empty:
+                            st.warning("以下員工姓名僅出現在部分來源，請確認是否為同一人或漏排班/漏打卡。")
+                            st.dataframe(df_mismatch)
+                        else: st.info("班表與打卡紀錄的員工姓名完全對應。")
+
+    st.markdown("---")
+    st.markdown("### 階段二：圖形化薪資單產出與會計報表")
+
+    col_a, col_b = st.columns(2)
+    with col_a:
+        st.markdown("##### 1. 會計核算參數")
+        revenue_input = st.number_input("請輸入本月營業總額 (供計算人事成本佔比)：", min_value=0, value=0, step=1000)
+        salary_param_file = st.file_uploader("4. 上傳 薪資與獎金設定表 (支援無限欄位擴充)", type=["xlsx"], key="salary")
     
-with col_b:
-    st.markdown("##### 2. 薪資單發放設定")
-    custom_msg = st.text_area("給同仁的當月結語 (將印在圖檔最下方)：", value="辛苦了，謝謝你本月的付出！", height=120)
-
-if salary_param_file and not st.session_state.df_final_calc.empty:
-    if st.button("執行第二階段：產出 JPG 薪資單與會計報表"):
-        with st.spinner('結合薪資基準繪製圖檔與結算會計報表中...'):
-            df_fixed, df_var, dyn_cols, dyn_fixed_cols, df_hr_reward, hr_pairs, err = parse_salary_params(salary_param_file)
-            if err:
-                st.error(err)
-            else:
-                payslip_records = generate_final_payslip(st.session_state.df_final_calc, df_fixed, df_var, dyn_cols, dyn_fixed_cols, df_hr_reward, hr_pairs)
-                
-                st.session_state.zip_data = create_zip_archive_images(payslip_records, selected_sheet, custom_msg)
-                st.session_state.excel_data = generate_accounting_excel(payslip_records, revenue_input)
-                st.session_state.stage2_done = True
+    with col_b:
+        st.markdown("##### 2. 薪資單發放設定")
+        custom_msg = st.text_area("給同仁的當月結語 (將印在圖檔最下方)：", value="辛苦了，謝謝你本月的付出！", height=120)
 
-    if st.session_state.get('stage2_done') and st.session_state.get('zip_data') and st.session_state.get('excel_data'):
-        st.success("結算與繪製完成！請點擊下方按鈕下載檔案。")
-        
-        dl_col1, dl_col2 = st.columns(2)
-        with dl_col1:
-            st.download_button(
-                label="📥 下載全體員工 JPG 薪資圖檔 (ZIP)",
-                data=st.session_state.zip_data,
-                file_name=f"IKKON_薪資圖檔_{selected_sheet}.zip",
-                mime="application/zip"
-            )
-        with dl_col2:
-            st.download_button(
-                label="📊 下載會計結算總表 (Excel)",
-                data=st.session_state.excel_data,
-                file_name=f"IKKON_會計結算總表_{selected_sheet}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
-
-elif salary_param_file and st.session_state.df_final_calc.empty:
-    st.warning("請先完成「第一階段：出缺勤試算」，再執行薪資發放。")
+    stage1 = artifact_store_get(artifact_store, st.session_state.stage1_key)
+    if st.session_state.stage1_key and stage1 is None:
+        st.session_state.stage1_key = None
+        st.session_state.stage2_key = None
+        st.warning("第一階段試算結果已逾時釋放，請重新執行第一階段。")
+    stage1_ready = stage1 is not None and not stage1["df_final_calc"].empty
+
+    if salary_param_file and stage1_ready:
+        if st.button("執行第二階段：薪資結算與會計報表"):
+            with st.spinner('結合薪資基準結算薪資與會計報表中...'):
+                stage2_key = artifact_key("stage2", st.session_state.stage1_key, salary_param_file.getvalue(), revenue_input)
+                stage2 = artifact_store_get(artifact_store, stage2_key)
+                err = ""
+                run_summary = None
+                if stage2 is None:
+                    def settle(params):
+                        # 主檔為多個 session 共用的倉儲物件，登錄薪資表姓名前先複製
+                        emp_master = copy.deepcopy(stage1["emp_master"])
+                        money_report = []
+                        payslip_records = generate_final_payslip(stage1["df_final_calc"], *params, emp_master, money_report)
+                        return payslip_records, money_report, employee_mismatch_report(emp_master, ["班表", "固定參數"])
+
+                    preview_cache = get_payslip_render_cache()
+
+                    def render_first_preview(settled):
+                        # 全體圖檔延後至下載時才繪製；預設預覽的第一位員工與會計報表同時先行繪製
+                        if settled[0]:
+                            render_payslip_cached(settled[0][0], selected_sheet, custom_msg, preview_cache)
+
+                    steps = {
+                        "解析薪資表": (lambda: unwrap_step_result(parse_salary_params(salary_param_file)), []),
+                        "薪資結算": (settle, ["解析薪資表"]),
+                        "會計報表": (lambda settled: generate_accounting_excel(settled[0], revenue_input, stage1["df_final_calc"], stage1["df_audit"]), ["薪資結算"]),
+                        "預覽薪資單繪製": (render_first_preview, ["薪資結算"])
+                    }
+                    try:
+                        results, run_summary = run_task_graph(steps)
+                    except StageInputError as e:
+                        err = str(e)
+                    if not err:
+                        payslip_records, money_report, df_salary_mismatch = results["薪資結算"]
+                        stage2 = artifact_store_put(artifact_store, stage2_key, {
+                            "payslip_records": payslip_records,
+                            "money_report": money_report,
+                            "df_salary_mismatch": df_salary_mismatch,
+                            "excel_data": results["會計報表"]
+                        })
+                if err:
+                    st.error(err)
+                else:
+                    if run_summary is not None:
+                        render_run_summary(run_summary)
+                    st.session_state.stage2_key = stage2_key
+
+                    if stage2["money_report"]:
+                        with st.expander(f"整數分精算與舊浮點運算結果不一致 ({len(stage2['money_report'])} 項，已採整數分結果)"):
+                            st.dataframe(pd.DataFrame(stage2["money_report"]))
+                    if not stage2["df_salary_mismatch"].empty:
+                        st.warning("薪資設定表與班表的員工姓名未完全對應，未對應者將以 0 元參數計算：")
+                        st.dataframe(stage2["df_salary_mismatch"])
+
+        stage2 = artifact_store_get(artifact_store, st.session_state.stage2_key)
+        if stage2 is not None and stage2["payslip_records"] and stage2["excel_data"]:
+            st.success("結算完成！可先預覽個別薪資單，確認無誤後再產出全體圖檔。")
+            payslip_records = stage2["payslip_records"]
+            render_cache = get_payslip_render_cache()
+
+            st.markdown("##### 薪資單預覽")
+            preview_names = [p['員工姓名'] for p in payslip_records]
+            preview_name = st.selectbox("選擇要預覽的員工：", preview_names)
+            if preview_name:
+                preview_record = payslip_records[preview_names.index(preview_name)]
+                preview_bytes, _ = render_payslip_cached(preview_record, selected_sheet, custom_msg, render_cache)
+                st.image(preview_bytes, caption=f"{preview_name}_{selected_sheet}薪資單", width=550)
+
+            # ZIP 以結算結果、月份與結語為鍵，任一變更即對應到不同產出物
+            zip_key = artifact_key("zip", st.session_state.stage2_key, selected_sheet, custom_msg)
+            zip_artifact = artifact_store_get(artifact_store, zip_key)
+
+            dl_col1, dl_col2 = st.columns(2)
+            with dl_col1:
+                if zip_artifact is None:
+                    if st.button("🖼️ 產出全體員工 JPG 薪資圖檔"):
+                        with st.spinner('繪製薪資圖檔中...'):
+                            zip_stats = {}
+                            zip_data = create_zip_archive_images(payslip_records, selected_sheet, custom_msg, render_cache, zip_stats)
+                            zip_artifact = artifact_store_put(artifact_store, zip_key, {"zip_data": zip_data, "zip_stats": zip_stats})
+                if zip_artifact is not None:
+                    zip_stats = zip_artifact["zip_stats"]
+                    if zip_stats:
+                        st.caption(f"本次重新繪製 {zip_stats.get('rendered', 0)} 張薪資單，沿用快取 {zip_stats.get('reused', 0)} 張。")
+                    st.download_button(
+                        label="📥 下載全體員工 JPG 薪資圖檔 (ZIP)",
+                        data=zip_artifact["zip_data"],
+                        file_name=f"IKKON_薪資圖檔_{selected_sheet}.zip",
+                        mime="application/zip"
+                    )
+            with dl_col2:
+                st.download_button(
+                    label="📊 下載會計結算總表 (Excel)",
+                    data=stage2["excel_data"],
+                    file_name=f"IKKON_會計結算總表_{selected_sheet}.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                )
+
+    elif salary_param_file and not stage1_ready:
+        st.warning("請先完成「第一階段：出缺勤試算」，再執行薪資發放。")
+
+# 平行結算的子行程 (spawn / forkserver) 會以 __mp_main__ 重新匯入本檔，介面只在 streamlit 執行時渲染
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,424 @@
+"""IKKON 薪資系統併發壓力測試
+
+以 `streamlit run` 啟動單一 app.py 伺服器，再由 N 個 WebSocket 客戶端 (每位店長一條執行緒) 同時連線，
+模擬瀏覽器上傳檔案並執行第一階段、第二階段與 ZIP 產出。所有 session 共用同一個 Runtime 與快取，
+回報各階段延遲百分位數、伺服器峰值 RSS 與吞吐量，用以評估單一主機可承受的同時結算數。
+
+    python loadtest.py --managers 8 --rounds 2 --employees 30
+
+相依套件：客戶端直接收發 Streamlit 的內部協定 (streamlit.proto 的 BackMsg / ForwardMsg，
+/_stcore/stream 與 /_stcore/upload_file 端點)，並非公開 API，僅於 Streamlit 1.66.0 測試通過，
+其他版本啟動時會提示。另需 websockets (sync 客戶端，11.0 起提供；以 17.2 測試) 與 requests，
+二者只供壓測使用，未列入 requirements.txt：
+
+    pip install "streamlit==1.66.0" "websockets>=11" requests
+"""
+import argparse
+import io
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urljoin
+
+import pandas as pd
+import requests
+import streamlit
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.WidgetStates_pb2 import WidgetState
+from websockets.sync.client import connect
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+STAGES = ["第一階段", "第二階段", "ZIP產出"]
+TESTED_STREAMLIT_VERSION = "1.66.0"
+
+# ==========================================
+# 測試資料產生器：iCHEF 打卡、班表、異常表、薪資設定表
+# ==========================================
+def _to_xlsx(sheets, header):
+    buf = io.BytesIO()
+    with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
+        for name, df in sheets.items():
+            df.to_excel(writer, sheet_name=name, header=header, index=False)
+    return buf.getvalue()
+
+def generate_workbooks(seed, n_employees=20, year=2025, month=3):
+    rng = random.Random(seed)
+    days = (datetime(year + month // 12, month % 12 + 1, 1) - datetime(year, month, 1)).days
+    names = [f"店{seed:03d}員工{i:02d}" for i in range(n_employees)]
+    pts = set(names[-max(1, n_employees // 4):])
+
+    roster_rows = [["", "職別"] + ["PT" if n in pts else "正職" for n in names], ["", "姓名"] + names]
+    ichef_rows = []
+    shifts = {}
+    for d in range(1, days + 1):
+        row = [datetime(year, month, d).strftime("%Y-%m-%d"), ""]
+        for n in names:
+            if n in pts:
+                v = rng.choice(["1100-2200", "1700-2300", None, "休"])
+            else:
+                v = None if rng.random() < 0.7 else rng.choice(["休", "1500-2300"])
+            shifts[(n, d)] = v
+            row.append(v)
+        roster_rows.append(row)
+
+    for n in names:
+        ichef_rows.append([n, None])
+        for d in range(1, days + 1):
+            v = shifts[(n, d)]
+            if v == "休" or (v is None and n in pts):
+                continue
+            base = datetime(year, month, d)
+
+            def t(h, m):
+                return (base + timedelta(hours=h, minutes=m + rng.randint(-8, 12))).strftime("%Y-%m-%d %H:%M:%S")
+
+            if v is None:
+                ichef_rows += [["上班", t(11, 0)], ["下班", t(14, 30)], ["上班", t(17, 0)], ["下班", t(23, 5)]]
+            elif v == "1100-2200":
+                ichef_rows += [["上班", t(11, 0)], ["下班", t(15, 0)], ["上班", t(17, 0)], ["下班", t(22, 0)]]
+            else:
+                ichef_rows += [["上班", t(int(v[:2]), 0)], ["下班", t(int(v[5:7]), 0)]]
+
+    anomaly = pd.DataFrame([["日期", "姓名", "指令", "精確時間", "時數異動", "數值", "事由"],
+                            [f"{year}-{month:02d}-03", names[0], "時數增減", "", "", 1.5, "盤點"]])
+    fixed = pd.DataFrame({
+        "部門": "外場", "員工姓名": names, "身份(正職或PT)": ["PT" if n in pts else "正職" for n in names],
+        "本薪或時薪": [rng.choice([190, 200]) if n in pts else rng.choice([31000, 33000, 35500]) for n in names],
+        "勞保扣款": 700, "健保扣款": 450
+    })
+    var = pd.DataFrame({"部門": "外場", "員工姓名": names, "全勤獎金": [rng.choice([0, 1000]) for _ in names]})
+
+    sheet = f"{year}-{month:02d}"
+    return {
+        "ichef": _to_xlsx({"Sheet1": pd.DataFrame(ichef_rows)}, header=False),
+        "roster": _to_xlsx({sheet: pd.DataFrame(roster_rows)}, header=False),
+        "anomaly": _to_xlsx({sheet: anomaly}, header=False),
+        "salary": _to_xlsx({"固定參數": fixed, "本月浮動獎金": var}, header=True),
+    }
+
+# ==========================================
+# 量測工具
+# ==========================================
+def current_rss_kb(pid="self"):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if pid == "self" else 0
+
+def _process_tree(root):
+    # 伺服器行程與其平行結算子行程都算進總用量
+    pids, frontier = [root], [root]
+    while frontier:
+        pid = frontier.pop()
+        try:
+            with open(f"/proc/{pid}/task/{pid}/children") as f:
+                kids = [int(x) for x in f.read().split()]
+        except OSError:
+            kids = []
+        pids += kids
+        frontier += kids
+    return pids
+
+class StageTracker:
+    """記錄各階段目前執行中的店長數，供 RSS 取樣判斷峰值歸屬。"""
+
+    def __init__(self):
+        self.active = [0] * len(STAGES)
+        self._lock = threading.Lock()
+
+    def mark(self, stage, delta):
+        with self._lock:
+            self.active[STAGES.index(stage)] += delta
+
+class RssSampler:
+    """背景取樣 streamlit 伺服器行程樹的 RSS 總和，記錄每個階段執行期間的峰值與整體峰值。"""
+
+    def __init__(self, server_pid, tracker, interval=0.05):
+        self.server_pid = server_pid
+        self.tracker = tracker
+        self.interval = interval
+        self.peaks = {stage: 0 for stage in STAGES}
+        self.total_peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss = sum(current_rss_kb(pid) for pid in _process_tree(self.server_pid))
+            self.total_peak = max(self.total_peak, rss)
+            for i, stage in enumerate(STAGES):
+                if self.tracker.active[i] > 0:
+                    self.peaks[stage] = max(self.peaks[stage], rss)
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+# ==========================================
+# streamlit 伺服器與 WebSocket 客戶端
+# ==========================================
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class StreamlitServer:
+    """以子行程執行 `streamlit run app.py`，結束時一併關閉。"""
+
+    def __init__(self, timeout=60):
+        self.port = _free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self.timeout = timeout
+        self.log = tempfile.NamedTemporaryFile(prefix="loadtest-streamlit-", suffix=".log", delete=False)
+        self.proc = None
+
+    def __enter__(self):
+        # 測試客戶端不帶 XSRF cookie，關閉檢查；其餘維持正式部署的預設設定
+        self.proc = subprocess.Popen(
+            [sys.executable, "-m", "streamlit", "run", APP_PATH, "--server.headless", "true",
+             "--server.address", "127.0.0.1", "--server.port", str(self.port),
+             "--server.enableXsrfProtection", "false", "--server.fileWatcherType", "none",
+             "--browser.gatherUsageStats", "false"],
+            stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                break
+            try:
+                if requests.get(f"{self.base_url}/_stcore/health", timeout=1).ok:
+                    return self
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        self.__exit__()
+        raise RuntimeError(f"streamlit 伺服器未能啟動，請查看 {self.log.name}")
+
+    def __exit__(self, *exc):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        self.log.close()
+
+def open_session(base_url, timeout):
+    return connect(base_url.replace("http", "ws", 1) + "/_stcore/stream", subprotocols=["streamlit"],
+                   max_size=None, open_timeout=timeout)
+
+class StreamlitClient:
+    """模擬單一瀏覽器分頁：維持 widget 狀態、上傳檔案並觸發 rerun。"""
+
+    def __init__(self, base_url, ws, timeout):
+        self.base_url = base_url
+        self.ws = ws
+        self.timeout = timeout
+        self.session_id = None
+        self.widget_states = {}
+        self.elements = []
+
+    def _recv(self):
+        msg = ForwardMsg()
+        msg.ParseFromString(self.ws.recv(timeout=self.timeout))
+        return msg
+
+    def rerun(self, trigger_id=None):
+        back = BackMsg()
+        back.rerun_script.SetInParent()
+        widgets = back.rerun_script.widget_states.widgets
+        for state in self.widget_states.values():
+            widgets.add().CopyFrom(state)
+        if trigger_id is not None:
+            widgets.add(id=trigger_id, trigger_value=True)
+        self.ws.send(back.SerializeToString())
+
+        elements = []
+        while True:
+            msg = self._recv()
+            kind = msg.WhichOneof("type")
+            if kind == "new_session":
+                self.session_id = msg.new_session.initialize.session_id or self.session_id
+                elements = []
+            elif kind == "delta" and msg.delta.WhichOneof("type") == "new_element":
+                elements.append(msg.delta.new_element)
+            elif kind == "script_finished" and msg.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                break
+        self.elements = elements
+        errors = [e.exception.message for e in elements if e.WhichOneof("type") == "exception"]
+        if errors:
+            raise RuntimeError(errors[0])
+
+    def widgets(self, kind):
+        return [getattr(e, kind) for e in self.elements if e.WhichOneof("type") == kind]
+
+    def upload(self, key, name, data):
+        uploader = next((w for w in self.widgets("file_uploader") if w.id.endswith(f"-{key}")), None)
+        if uploader is None:
+            raise RuntimeError(f"找不到上傳欄位：{key}")
+        request = BackMsg()
+        request.file_urls_request.request_id = name
+        request.file_urls_request.file_names.append(name)
+        request.file_urls_request.session_id = self.session_id
+        self.ws.send(request.SerializeToString())
+        while True:
+            msg = self._recv()
+            if msg.WhichOneof("type") == "file_urls_response" and msg.file_urls_response.response_id == name:
+                break
+        if msg.file_urls_response.error_msg:
+            raise RuntimeError(msg.file_urls_response.error_msg)
+        urls = msg.file_urls_response.file_urls[0]
+        resp = requests.put(urljoin(self.base_url, urls.upload_url), files={"file": (name, data)}, timeout=self.timeout)
+        resp.raise_for_status()
+
+        state = WidgetState(id=uploader.id)
+        info = state.file_uploader_state_value.uploaded_file_info.add(name=name, size=len(data), file_id=urls.file_id)
+        info.file_urls.CopyFrom(urls)
+        self.widget_states[uploader.id] = state
+        self.rerun()
+
+    def click(self, label_part):
+        buttons = [b for b in self.widgets("button") if label_part in b.label]
+        if not buttons:
+            raise RuntimeError(f"找不到按鈕：{label_part}")
+        self.rerun(trigger_id=buttons[0].id)
+
+# ==========================================
+# 模擬單一店長的完整操作流程
+# ==========================================
+def simulate_manager(base_url, workbooks, tracker, timeout):
+    """回傳 (各階段耗時, 命中產出物快取而未執行的階段)。"""
+    timings, cache_hits = {}, []
+    with open_session(base_url, timeout) as ws:
+        client = StreamlitClient(base_url, ws, timeout)
+        client.rerun()
+        client.upload("ichef", "ichef.xlsx", workbooks["ichef"])
+        client.upload("roster", "roster.xlsx", workbooks["roster"])
+        client.upload("anomaly", "anomaly.xlsx", workbooks["anomaly"])
+
+        for stage, label in [("第一階段", "第一階段"), ("第二階段", "第二階段"), ("ZIP產出", "JPG")]:
+            if stage == "第二階段":
+                client.upload("salary", "salary.xlsx", workbooks["salary"])
+            if stage == "ZIP產出" and not any(label in b.label for b in client.widgets("button")):
+                # 相同結算結果的 ZIP 已在倉儲中，畫面直接提供下載；另行計數，不列入延遲分布
+                cache_hits.append(stage)
+                continue
+            tracker.mark(stage, 1)
+            start = time.perf_counter()
+            try:
+                client.click(label)
+            finally:
+                timings[stage] = time.perf_counter() - start
+                tracker.mark(stage, -1)
+    return timings, cache_hits
+
+def run_load_test(managers, rounds, employees, shared_inputs=False, timeout=300):
+    # 預設每位店長、每一輪都使用不同資料，避免產出物快取命中而低估負載
+    print(f"產生測試資料：{managers} 位店長 × {rounds} 輪 × {employees} 位員工 ...")
+    datasets = [[generate_workbooks(0 if shared_inputs else r * managers + i, employees) for i in range(managers)]
+                for r in range(rounds)]
+    latencies = {stage: [] for stage in STAGES}
+    cache_hits = {stage: 0 for stage in STAGES}
+    failures = []
+    tracker = StageTracker()
+
+    with StreamlitServer() as server, ThreadPoolExecutor(max_workers=managers) as pool:
+        # 先跑一次空白頁面讓伺服器完成 app.py 的 import，啟動成本不列入量測
+        with open_session(server.base_url, timeout) as ws:
+            StreamlitClient(server.base_url, ws, timeout).rerun()
+        with RssSampler(server.proc.pid, tracker) as sampler:
+            wall_start = time.perf_counter()
+            for r in range(rounds):
+                futures = [pool.submit(simulate_manager, server.base_url, datasets[r][i], tracker, timeout)
+                           for i in range(managers)]
+                for fut in futures:
+                    try:
+                        timings, hits = fut.result()
+                        for stage, secs in timings.items():
+                            latencies[stage].append(secs)
+                        for stage in hits:
+                            cache_hits[stage] += 1
+                    except Exception as e:
+                        failures.append(f"{type(e).__name__}: {e}")
+            wall = time.perf_counter() - wall_start
+
+    report = {"managers": managers, "rounds": rounds, "employees": employees, "wall_seconds": wall,
+              "failures": failures, "stages": {}}
+    for stage in STAGES:
+        vals = latencies[stage]
+        busy = sum(vals)
+        report["stages"][stage] = {
+            "runs": len(vals),
+            "cache_hits": cache_hits[stage],
+            "p50": percentile(vals, 50), "p90": percentile(vals, 90),
+            "p95": percentile(vals, 95), "p99": percentile(vals, 99),
+            "max": max(vals) if vals else 0.0,
+            "throughput_per_min": (len(vals) / wall * 60.0) if wall > 0 else 0.0,
+            "mean_concurrency": busy / wall if wall > 0 else 0.0,
+            "peak_rss_mb": sampler.peaks[stage] / 1024.0
+        }
+    report["peak_rss_mb"] = sampler.total_peak / 1024.0
+    return report
+
+def print_report(report):
+    print(f"\n併發店長 {report['managers']} 位 × {report['rounds']} 輪，每店 {report['employees']} 位員工，總耗時 {report['wall_seconds']:.1f}s")
+    header = f"{'階段':<8}{'次數':>6}{'快取命中':>8}{'p50':>9}{'p90':>9}{'p95':>9}{'p99':>9}{'max':>9}{'次/分':>9}{'峰值RSS(MB)':>13}"
+    print(header)
+    print("-" * len(header))
+    for stage, s in report["stages"].items():
+        print(f"{stage:<8}{s['runs']:>6}{s['cache_hits']:>8}{s['p50']:>8.2f}s{s['p90']:>8.2f}s{s['p95']:>8.2f}s{s['p99']:>8.2f}s"
+              f"{s['max']:>8.2f}s{s['throughput_per_min']:>9.1f}{s['peak_rss_mb']:>13.1f}")
+    print(f"伺服器行程合計峰值 RSS：{report['peak_rss_mb']:.1f} MB")
+    if report["failures"]:
+        print(f"失敗 {len(report['failures'])} 次：")
+        for msg in report["failures"][:10]:
+            print(f"  - {msg}")
+
+def main():
+    parser = argparse.ArgumentParser(description="IKKON 薪資系統併發壓力測試")
+    parser.add_argument("--managers", type=int, default=4, help="同時操作的店長數")
+    parser.add_argument("--rounds", type=int, default=1, help="重複輪數")
+    parser.add_argument("--employees", type=int, default=20, help="每間店的員工數")
+    parser.add_argument("--shared-inputs", action="store_true", help="所有店長、所有輪次上傳相同檔案 (共用伺服器快取，ZIP 產出可能直接命中)")
+    parser.add_argument("--timeout", type=float, default=300, help="單次 rerun 逾時秒數")
+    parser.add_argument("--json", help="將結果另存為 JSON 檔")
+    args = parser.parse_args()
+
+    if streamlit.__version__ != TESTED_STREAMLIT_VERSION:
+        print(f"注意：本腳本使用 Streamlit 內部協定，於 {TESTED_STREAMLIT_VERSION} 測試通過，目前安裝 {streamlit.__version__}。", file=sys.stderr)
+    warnings.simplefilter("ignore")
+    report = run_load_test(args.managers, args.rounds, args.employees, args.shared_inputs, args.timeout)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,616 @@
+import pandas as pd
+import numpy as np
+import os
+import sys
+import copy
+import json
+import bisect
+import unicodedata
+import multiprocessing as mp
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+# 出勤結算核心：員工主檔、班別規則、班表時段索引與工時碰撞引擎。
+# 獨立於 app.py 之外，平行結算的行程池才能以固定模組名稱傳遞工作函式；
+# streamlit 每次 rerun 都會替換 __main__，定義在 app.py 的函式無法跨 rerun 序列化。
+
+# ==========================================
+# 員工主檔索引：全流程統一以整數員工 ID 對接
+# ==========================================
+def normalize_employee_name(name):
+    # NFKC 將全形英數與空白轉半形，再移除所有空白，杜絕「王小明 」與「王 小明」對不上
+    if name is None:
+        return ""
+    s = str(name)
+    if s in ["nan", "NaT", "None"]:
+        return ""
+    return "".join(unicodedata.normalize('NFKC', s).split())
+
+def register_employee_names(master, source, names):
+    seen = master["sources"].setdefault(source, set())
+    for raw in names:
+        key = normalize_employee_name(raw)
+        if not key:
+            continue
+        emp_id = master["ids"].get(key)
+        if emp_id is None:
+            emp_id = len(master["names"]) + 1
+            master["ids"][key] = emp_id
+            master["names"][emp_id] = str(raw).strip()
+        master["variants"].setdefault(emp_id, set()).add(str(raw))
+        seen.add(emp_id)
+    return master
+
+def build_employee_master(sources):
+    """sources 為 {來源名稱: 姓名序列}，回傳正規化姓名 → 員工 ID 的主檔索引。"""
+    master = {"ids": {}, "names": {}, "variants": {}, "sources": {}}
+    for source, names in sources.items():
+        register_employee_names(master, source, names)
+    return master
+
+def lookup_employee_id(master, name):
+    return master["ids"].get(normalize_employee_name(name))
+
+def attach_employee_ids(df, master, name_col):
+    if df is None or df.empty or name_col not in df.columns:
+        return df
+    # 每個原始姓名只正規化一次，其餘皆為雜湊查表
+    id_map = {raw: lookup_employee_id(master, raw) for raw in df[name_col].unique()}
+    df['員工ID'] = df[name_col].map(id_map)
+    return df
+
+def employee_mismatch_report(master, required_sources=None):
+    required = list(required_sources) if required_sources else list(master["sources"].keys())
+    rows = []
+    for emp_id, name in master["names"].items():
+        found = [s for s, ids in master["sources"].items() if emp_id in ids]
+        missing = [s for s in required if s in master["sources"] and emp_id not in master["sources"][s]]
+        if missing:
+            rows.append({
+                "員工ID": emp_id,
+                "員工姓名": name,
+                "名稱變體": " / ".join(sorted(master["variants"].get(emp_id, []))),
+                "出現來源": "、".join(found),
+                "缺少來源": "、".join(missing)
+            })
+    return pd.DataFrame(rows)
+
+# ==========================================
+# 店鋪班別規則：規則檔於載入時編譯為查表，核心引擎不再逐列解析班別字串
+# ==========================================
+DEFAULT_SHIFT_RULES = {
+    "寬限分鐘": 30,
+    "重複打卡合併分鐘": 20,
+    "正職班別": {
+        "正常班": {
+            "時段": [["11:00", "14:30"], ["17:00", "23:00"]],
+            "分段點": ["15:30"],
+            "基本時數": 8.5,
+            # 首次打卡在 13:00 之後且打卡少於 3 次，視為只上晚段的單段班
+            "單段替代": {"首次打卡不早於": "13:00", "打卡次數少於": 3, "時段": [["15:00", "23:00"]], "基本時數": 8.0}
+        }
+    },
+    "PT班別": {
+        "1100-2200": {"時段": [["11:00", "15:30"], ["17:00", "22:00"]], "分段點": ["15:30"]}
+    }
+}
+
+def _rule_minutes(value, field):
+    text = str(value).strip().replace(":", "")
+    if len(text) != 4 or not text.isdigit() or int(text[:2]) >= 24 or int(text[2:]) >= 60:
+        raise ValueError(f"{field} 時間格式錯誤：{value} (請使用 HH:MM)")
+    return int(text[:2]) * 60 + int(text[2:])
+
+def _compile_shift_template(spec, name, grace):
+    segments = []
+    for pair in spec.get("時段", []):
+        start, end = _rule_minutes(pair[0], f"{name} 時段"), _rule_minutes(pair[1], f"{name} 時段")
+        if end < start:
+            end += 24 * 60
+        segments.append((pd.Timedelta(minutes=start), pd.Timedelta(minutes=end)))
+    if not segments:
+        raise ValueError(f"班別「{name}」未定義時段。")
+    split = sorted(_rule_minutes(v, f"{name} 分段點") for v in spec.get("分段點", []))
+    if len(split) != len(segments) - 1:
+        raise ValueError(f"班別「{name}」有 {len(segments)} 個時段，需要 {len(segments) - 1} 個分段點。")
+    duration = (segments[-1][1] - segments[0][0]).total_seconds() / 3600.0
+    tpl = {
+        "segments": segments, "split": split,
+        "base_hours": float(spec.get("基本時數", duration)),
+        "grace": pd.Timedelta(minutes=float(spec.get("寬限分鐘", grace))),
+        "window": (segments[0][0], segments[-1][1]),
+        "alt": None
+    }
+    alt = spec.get("單段替代")
+    if alt:
+        tpl["alt"] = _compile_shift_template(alt, f"{name}(單段替代)", spec.get("寬限分鐘", grace))
+        tpl["alt_min_in"] = _rule_minutes(alt.get("首次打卡不早於", "00:00"), f"{name} 單段替代")
+        tpl["alt_max_punches"] = int(alt.get("打卡次數少於", sys.maxsize))
+    return tpl
+
+def _parse_range_time(text):
+    # 與原判定相同，以 pandas 解析 HHMM，只在班別字串首次出現時執行
+    try:
+        return pd.to_datetime(f"2000-01-01 {text[:2]}:{text[2:]}") - pd.Timestamp("2000-01-01")
+    except (ValueError, TypeError):
+        return None
+
+def _compile_range_shift(shift_str, need_end):
+    if not shift_str or shift_str == "正常班" or "-" not in shift_str:
+        return None
+    parts = shift_str.split('-')
+    start = _parse_range_time(parts[0])
+    end = _parse_range_time(parts[1]) if len(parts) == 2 else None
+    if start is None or (need_end and end is None):
+        return None
+    if end is None:
+        # PT 只需表定上班時間
+        return {"segments": [(start, None)], "split": [], "window": None, "alt": None}
+    if end < start:
+        end += pd.Timedelta(days=1)
+    return {"segments": [(start, end)], "split": [], "base_hours": (end - start).total_seconds() / 3600.0,
+            "window": (start, end), "alt": None}
+
+def compile_shift_rules(rules=None):
+    """將規則 (預設或店鋪規則檔) 編譯為引擎查表。店鋪規則只需列出與預設不同的項目，班別以名稱逐一覆蓋。"""
+    merged = copy.deepcopy(DEFAULT_SHIFT_RULES)
+    for key, value in (rules or {}).items():
+        if key in ("正職班別", "PT班別"):
+            merged[key].update(value)
+        else:
+            merged[key] = value
+    grace = float(merged["寬限分鐘"])
+    full = {name: _compile_shift_template(spec, name, grace) for name, spec in merged["正職班別"].items()}
+    pt = {name: _compile_shift_template(spec, name, grace) for name, spec in merged["PT班別"].items()}
+    if "正常班" not in full:
+        raise ValueError("規則檔缺少「正常班」：班表空白格一律視為正常班。")
+    return {
+        "grace": pd.Timedelta(minutes=grace),
+        "dedupe_minutes": float(merged["重複打卡合併分鐘"]),
+        "full": full, "pt": pt,
+        "default_window": full["正常班"]["window"],
+        "fallback_base_hours": full["正常班"]["base_hours"]
+    }
+
+def load_shift_rules(file):
+    try:
+        rules = json.loads(file.getvalue())
+        if not isinstance(rules, dict):
+            return None, "班別規則檔格式錯誤：最外層需為物件。"
+        return compile_shift_rules(rules), ""
+    except (ValueError, TypeError, KeyError, IndexError, AttributeError) as e:
+        return None, f"班別規則檔解析失敗：{e}"
+
+def resolve_shift_template(rules, kind, shift_str, cache=None):
+    """查表取得班別樣板；kind 為 "full" (正職) 或 "pt"。
+
+    規則未列出的 HHMM-HHMM 即時編譯，快取於呼叫端傳入的 cache (單次結算專用)，不寫回共用的規則查表。
+    """
+    table = rules[kind]
+    if shift_str in table:
+        return table[shift_str]
+    if cache is None:
+        return _compile_range_shift(shift_str, need_end=(kind == "full"))
+    key = (kind, shift_str)
+    if key not in cache:
+        cache[key] = _compile_range_shift(shift_str, need_end=(kind == "full"))
+    return cache[key]
+
+DEFAULT_COMPILED_SHIFT_RULES = compile_shift_rules()
+
+# ==========================================
+# 班表時段索引：打卡以二分搜尋歸屬至最近的表定時段
+# ==========================================
+def shift_window(date, shift_str, emp_type="正職", rules=None, cache=None):
+    rules = rules or DEFAULT_COMPILED_SHIFT_RULES
+    tpl = resolve_shift_template(rules, "pt" if emp_type == "PT" else "full", shift_str, cache)
+    start, end = (tpl["window"] if tpl and tpl["window"] else None) or rules["default_window"]
+    day = pd.Timestamp(date)
+    return day + start, day + end
+
+def build_shift_interval_index(df_roster, shift_rules=None, template_cache=None):
+    """回傳 {員工ID: (時段起點陣列, 時段終點陣列, 班表日期陣列)}，依起點排序。排休日以正常班時段代表。"""
+    window_cache = {}
+    windows = {}
+    for emp_id, date, emp_type, shift_str in zip(df_roster['員工ID'], df_roster['日期'], df_roster['身份'], df_roster['班別字串']):
+        key = (date, emp_type == "PT", shift_str)
+        if key not in window_cache:
+            start, end = shift_window(date, shift_str, emp_type, shift_rules, template_cache)
+            window_cache[key] = (start.value, end.value)
+        windows.setdefault(emp_id, []).append(window_cache[key] + (date,))
+
+    index = {}
+    for emp_id, wins in windows.items():
+        wins.sort()
+        index[emp_id] = (
+            np.array([w[0] for w in wins], dtype=np.int64),
+            np.array([w[1] for w in wins], dtype=np.int64),
+            np.array([w[2] for w in wins], dtype=object)
+        )
+    return index
+
+# 打卡落在班表日期範圍外，且距離最近的表定時段超過此上限時不予歸屬，避免月份外的打卡被併入首日或末日
+SHIFT_ASSIGN_MAX_GAP = pd.Timedelta(hours=6)
+
+def assign_punches_to_shifts(df_actual, shift_index, max_gap=SHIFT_ASSIGN_MAX_GAP):
+    # 每位員工一次向量化二分搜尋；取前後相鄰時段中距離最近者，等距時歸屬較早的時段
+    assigned = np.full(len(df_actual), None, dtype=object)
+    if df_actual.empty:
+        return assigned
+    anchors = df_actual['temp_time'].to_numpy(dtype='datetime64[ns]').view(np.int64)
+    nat = np.datetime64('NaT').astype('datetime64[ns]').view(np.int64)
+    for emp_id, pos in df_actual.groupby('員工ID', sort=False).indices.items():
+        wins = shift_index.get(emp_id)
+        if wins is None:
+            continue
+        starts, ends, dates = wins
+        t = anchors[pos]
+        idx = np.searchsorted(starts, t, side='right') - 1
+        cand = np.stack([idx - 1, idx, idx + 1])
+        valid = (cand >= 0) & (cand < len(starts))
+        c = np.clip(cand, 0, len(starts) - 1)
+        dist = np.maximum(starts[c] - t, 0) + np.maximum(t - ends[c], 0)
+        dist = np.where(valid, dist, np.iinfo(np.int64).max)
+        nearest = np.argmin(dist, axis=0)
+        cols = np.arange(len(pos))
+        best = c[nearest, cols]
+        near = dist[nearest, cols] <= max_gap.value
+        calendar = np.datetime_as_string(t.view('datetime64[ns]'), unit='D')
+        in_span = (calendar >= min(dates)) & (calendar <= max(dates))
+        assigned[pos] = np.where((t != nat) & (near | in_span), dates[best], None)
+    return assigned
+
+def split_punch_segments(all_times, split):
+    # 依分段點 (當日分鐘數) 切分打卡，恰落在分段點上的打卡歸前段
+    segs = [[] for _ in range(len(split) + 1)]
+    for t in all_times:
+        segs[bisect.bisect_left(split, t.hour * 60 + t.minute)].append(t)
+    return segs
+
+# ==========================================
+# 核心引擎：工時碰撞 (支援多重打卡免疫與物理時段分割)
+# ==========================================
+def snap_punch_time(dt, is_in):
+    if is_in:
+        if dt.minute == 0 and dt.second == 0:
+            return dt
+        elif dt.minute < 30 or (dt.minute == 30 and dt.second == 0):
+            return dt.replace(minute=30, second=0, microsecond=0)
+        else:
+            return (dt + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+    else:
+        if dt.minute < 30:
+            return dt.replace(minute=0, second=0, microsecond=0)
+        else:
+            return dt.replace(minute=30, second=0, microsecond=0)
+
+def calculate_payroll_hours(df_roster, df_actual, df_anomaly, emp_master=None, shift_rules=None):
+    shift_rules = shift_rules or DEFAULT_COMPILED_SHIFT_RULES
+    # 規則未列出的 HHMM-HHMM 班別只在本次結算內快取
+    template_cache = {}
+    results = []
+    audit_logs = []
+
+    if emp_master is None:
+        emp_master = build_employee_master({
+            "班表": df_roster['員工'],
+            "iCHEF打卡": df_actual['員工'],
+            "異常表": df_anomaly['員工'] if not df_anomaly.empty else []
+        })
+    attach_employee_ids(df_roster, emp_master, '員工')
+    attach_employee_ids(df_actual, emp_master, '員工')
+    attach_employee_ids(df_anomaly, emp_master, '員工')
+
+    # 無條件抹除秒數，杜絕 15:00:59 引發的判定誤差
+    df_actual['上班時間'] = pd.to_datetime(df_actual['上班時間']).dt.floor('T')
+    df_actual['下班時間'] = pd.to_datetime(df_actual['下班時間']).dt.floor('T')
+    df_actual['temp_time'] = df_actual['上班時間'].fillna(df_actual['下班時間'])
+    # 打卡依班表時段歸屬日期，跨午夜的大夜班與延後下班不再落入隔日
+    df_actual['日期'] = assign_punches_to_shifts(df_actual, build_shift_interval_index(df_roster, shift_rules, template_cache))
+
+    # 以 (員工ID, 日期) 預先分組，迴圈內改為雜湊查表，不再逐日全表掃描
+    punch_lookup = {key: grp for key, grp in df_actual.groupby(['員工ID', '日期'], sort=False)}
+    anomaly_lookup = {}
+    if not df_anomaly.empty:
+        anomaly_lookup = {key: grp for key, grp in df_anomaly.groupby(['員工ID', '日期'], sort=False)}
+    no_rows = df_actual.iloc[0:0]
+
+    for _, scheduled in df_roster.iterrows():
+        date = scheduled['日期']
+        emp = scheduled['員工']
+        emp_id = scheduled['員工ID']
+        emp_type = scheduled['身份']
+        original_shift_str = scheduled['班別字串']
+        is_working = scheduled['表定上班狀態']
+
+        emp_punches = punch_lookup.get((emp_id, date), no_rows)
+
+        shift_str = original_shift_str
+        manual_add_ot = 0.0
+        missing_punch_dts = []
+        override_reasons = []
+        has_override = False
+        waive_penalty = False 
+        
+        emp_anomalies = anomaly_lookup.get((emp_id, date))
+        if emp_anomalies is not None:
+            for _, anom in emp_anomalies.iterrows():
+                cmd = anom['指令']
+                reason = str(anom['原因'])
+                exact_time = str(anom['精確時間']).strip() if pd.notna(anom['精確時間']) else ""
+                time_range = str(anom['時數異動脈絡']).strip() if pd.notna(anom['時數異動脈絡']) else ""
+                
+                if cmd == "變更為排休":
+                    shift_str = "休"
+                    is_working = False
+                    has_override = True
+                    waive_penalty = True
+                    override_reasons.append(f"調休變更: {reason}")
+                elif cmd == "變更為應勤":
+                    shift_str = "正常班"
+                    is_working = True
+                    has_override = True
+                    waive_penalty = True
+                    override_reasons.append(f"調休變更: {reason}")
+                elif cmd in ["補登上班", "補登下班", "上班補登", "下班補登"]:
+                    if exact_time:
+                        ts = exact_time
+                        if len(ts) == 5: ts += ":00"
+                        try:
+                            dt = pd.to_datetime(f"{date} {ts}").floor('T')
+                            missing_punch_dts.append(dt)
+                            has_override = True
+                            override_reasons.append(f"{cmd} {ts}: {reason}")
+                        except: pass
+                elif cmd == "時數增減":
+                    if anom['時數'] != 0.0:
+                        manual_add_ot += anom['時數']
+                        has_override = True
+                        waive_penalty = True 
+                        if time_range and time_range.lower() not in ["nan", "none", ""]:
+                            override_reasons.append(f"時數增減 {anom['時數']}H [{time_range}]: {reason}")
+                        else:
+                            override_reasons.append(f"時數增減 {anom['時數']}H: {reason}")
+
+        raw_times = []
+        for _, punch in emp_punches.iterrows():
+            if pd.notna(punch['上班時間']): raw_times.append(punch['上班時間'])
+            if pd.notna(punch['下班時間']): raw_times.append(punch['下班時間'])
+        raw_times.extend(missing_punch_dts)
+        raw_times.sort()
+
+        # 【第一道絕對防禦：打卡訊號淨化器】
+        # 無情抹除所有 20 分鐘 (依店鋪規則) 內的重複打卡，還原真實的 In/Out 軌跡
+        all_times = []
+        if raw_times:
+            all_times = [raw_times[0]]
+            for t in raw_times[1:]:
+                if (t - all_times[-1]).total_seconds() / 60.0 > shift_rules["dedupe_minutes"]:
+                    all_times.append(t)
+        
+        if not is_working and not all_times:
+            if has_override and manual_add_ot != 0:
+                results.append({"日期": date, "員工": emp, "員工ID": emp_id, "身份": emp_type, "班別": shift_str, "遲到(分)": 0, "早退(分)": 0, "加班(時)": manual_add_ot, "總工時(時)": 0, "狀態": "已套用異常覆寫"})
+                audit_logs.append({"日期": date, "員工": emp, "原始判定": "排休無打卡", "覆寫內容": "已執行上述指令", "幹部備註原因": " | ".join(override_reasons)})
+            continue
+            
+        if is_working and not all_times:
+            final_status = "已套用異常覆寫" if has_override else "無打卡紀錄(曠職或未核)"
+            results.append({"日期": date, "員工": emp, "員工ID": emp_id, "身份": emp_type, "班別": shift_str, "遲到(分)": 0, "早退(分)": 0, "加班(時)": manual_add_ot, "總工時(時)": 0, "狀態": final_status})
+            if has_override:
+                audit_logs.append({"日期": date, "員工": emp, "原始判定": "曠職或未核", "覆寫內容": "已執行上述指令", "幹部備註原因": " | ".join(override_reasons)})
+            continue
+
+        actual_in = all_times[0]
+        span_hours = (all_times[-1] - actual_in).total_seconds() / 3600.0
+
+        if not is_working and all_times:
+            snapped_times = [snap_punch_time(t, is_in=(i % 2 == 0)) for i, t in enumerate(all_times)]
+            if len(snapped_times) % 2 == 0:
+                total_actual_hours = sum([max(0, (snapped_times[i+1] - snapped_times[i]).total_seconds() / 3600.0) for i in range(0, len(snapped_times)-1, 2)])
+            else:
+                total_actual_hours = max(0, (snap_punch_time(all_times[-1], False) - snap_punch_time(all_times[0], True)).total_seconds() / 3600.0)
+                
+            support_ot = total_actual_hours + manual_add_ot
+            results.append({"日期": date, "員工": emp, "員工ID": emp_id, "身份": emp_type, "班別": shift_str, "遲到(分)": 0, "早退(分)": 0, "加班(時)": support_ot, "總工時(時)": round(total_actual_hours, 2), "狀態": "休假支援(全額加班)"})
+            if has_override: audit_logs.append({"日期": date, "員工": emp, "原始判定": "休假支援", "覆寫內容": "已執行上述指令", "幹部備註原因": " | ".join(override_reasons)})
+            continue
+
+        day = pd.Timestamp(date)
+        if emp_type == "PT":
+            total_actual_hours = 0
+            tpl = resolve_shift_template(shift_rules, "pt", shift_str, template_cache)
+            if tpl is not None and len(tpl["segments"]) >= 2:
+                segs = split_punch_segments(all_times, tpl["split"])
+                for (sched_start, _), seg in zip(tpl["segments"], segs):
+                    if len(seg) >= 2:
+                        seg_in = max(seg[0], day + sched_start)
+                        total_actual_hours += max(0, (seg[-1] - seg_in).total_seconds() / 3600.0)
+                if not any(segs):
+                    total_actual_hours = sum([(all_times[i+1] - all_times[i]).total_seconds() / 3600.0 for i in range(0, len(all_times)-1, 2)]) if len(all_times) % 2 == 0 else span_hours
+            elif tpl is not None:
+                in_time = max(all_times[0], day + tpl["segments"][0][0])
+                total_actual_hours += max(0, (all_times[-1] - in_time).total_seconds() / 3600.0)
+            else:
+                total_actual_hours = (all_times[-1] - all_times[0]).total_seconds() / 3600.0 if len(all_times) >= 2 else 0
+
+            pt_mins = round(total_actual_hours * 60.0, 2)
+            pt_hours = (pt_mins // 30) * 0.5
+            pt_hours += manual_add_ot
+            
+            final_status = "已套用異常覆寫" if has_override else "PT時數結算"
+            results.append({"日期": date, "員工": emp, "員工ID": emp_id, "身份": emp_type, "班別": shift_str, "遲到(分)": 0, "早退(分)": 0, "加班(時)": manual_add_ot, "總工時(時)": pt_hours, "狀態": final_status})
+            if has_override: audit_logs.append({"日期": date, "員工": emp, "原始判定": "PT工時結算", "覆寫內容": "已執行上述指令", "幹部備註原因": " | ".join(override_reasons)})
+            continue
+            
+        late_mins = 0
+        early_leave_mins = 0
+        total_calculated_hours = 0
+        
+        tpl = resolve_shift_template(shift_rules, "full", shift_str, template_cache)
+        if tpl is not None and tpl["alt"] is not None:
+            in_minutes = actual_in.hour * 60 + actual_in.minute
+            if in_minutes >= tpl["alt_min_in"] and len(all_times) < tpl["alt_max_punches"]:
+                tpl = tpl["alt"]
+
+        if tpl is None:
+            base_hours = shift_rules["fallback_base_hours"]
+        elif len(tpl["segments"]) >= 2:
+            # 【第二道絕對防禦：時段物理分割】
+            # 強制以分段點 (預設 15:30) 為界拆分打卡陣列。徹底免疫任何未知的多重打卡陣列錯位。
+            segs = split_punch_segments(all_times, tpl["split"])
+            last = len(segs) - 1
+            for i, ((sched_start, sched_end), seg) in enumerate(zip(tpl["segments"], segs)):
+                if not seg:
+                    continue
+                sched_in, sched_out = day + sched_start, day + sched_end
+                act_in, act_out = seg[0], seg[-1]
+                if act_in > sched_in: late_mins += int((act_in - sched_in).total_seconds() / 60)
+                seg_in = max(act_in, sched_in)
+                # 末段於寬限時間內提前下班視同準時
+                if i == last and act_out < sched_out and (sched_out - act_out) <= tpl["grace"]:
+                    seg_out = sched_out
+                else:
+                    seg_out = min(act_out, sched_out)
+                    if i == last:
+                        diff = int((sched_out - act_out).total_seconds() / 60)
+                        if diff > tpl["grace"].total_seconds() / 60: early_leave_mins = diff
+                if seg_out > seg_in: total_calculated_hours += (seg_out - seg_in).total_seconds() / 3600.0
+            base_hours = tpl["base_hours"]
+        else:
+            sched_start, sched_end = tpl["segments"][0]
+            sched_in, sched_out = day + sched_start, day + sched_end
+            s_act_in = all_times[0]
+            s_act_out = all_times[-1]
+            if s_act_in > sched_in: late_mins += int((s_act_in - sched_in).total_seconds() / 60)
+            if s_act_out < sched_out:
+                diff = int((sched_out - s_act_out).total_seconds() / 60)
+                if diff > tpl.get("grace", shift_rules["grace"]).total_seconds() / 60: early_leave_mins = diff
+                valid_out = s_act_out
+            else: 
+                valid_out = min(s_act_out, sched_out)
+                
+            valid_in = max(s_act_in, sched_in)
+            if valid_out > valid_in:
+                total_calculated_hours = (valid_out - valid_in).total_seconds() / 3600.0
+            base_hours = tpl["base_hours"]
+
+        if waive_penalty:
+            late_mins = 0
+            early_leave_mins = 0
+                
+        overflow = total_calculated_hours - base_hours
+        overtime_hours = (overflow // 0.5) * 0.5 if overflow > 0 else 0
+        overtime_hours += manual_add_ot
+        final_status = "已套用異常覆寫" if has_override else "正常結算"
+            
+        results.append({"日期": date, "員工": emp, "員工ID": emp_id, "身份": "正職", "班別": shift_str, "遲到(分)": late_mins, "早退(分)": early_leave_mins, "加班(時)": overtime_hours, "總工時(時)": round(total_calculated_hours, 2), "狀態": final_status})
+        if has_override: audit_logs.append({"日期": date, "員工": emp, "原始判定": "異常/正常結算", "覆寫內容": "已執行上述指令", "幹部備註原因": " | ".join(override_reasons)})
+
+    return pd.DataFrame(results), pd.DataFrame(audit_logs)
+
+# ==========================================
+# 員工分區：分段處理模式與多核心平行結算共用
+# ==========================================
+PUNCH_COLUMNS = ['員工', '上班時間', '下班時間']
+
+def partition_by_employee(df, master):
+    if df is None or df.empty:
+        return {}
+    attach_employee_ids(df, master, '員工')
+    return {emp_id: grp.copy() for emp_id, grp in df.groupby('員工ID', sort=False)}
+
+def order_like_roster(df, df_roster, master):
+    # 與逐日單執行緒結算相同的輸出順序：日期優先，同日依班表員工欄位順序
+    if df.empty:
+        return df
+    emp_rank = {emp_id: rank for rank, emp_id in enumerate(pd.unique(df_roster['員工ID']))}
+    ranks = df['員工'].map(lambda name: emp_rank.get(lookup_employee_id(master, name), len(emp_rank)))
+    order = sorted(range(len(df)), key=lambda i: (df['日期'].iat[i], ranks.iat[i]))
+    return df.iloc[order].reset_index(drop=True)
+
+# ==========================================
+# 多核心平行結算：依員工分區交由行程池運算
+# ==========================================
+_PARALLEL_STATE = {}
+
+def _init_parallel_worker(shm_name, n_rows, emp_master, shift_rules):
+    # 打卡時間陣列放在共享記憶體，子行程直接掛載切片，不經 pickle 複製
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _PARALLEL_STATE["shm"] = shm
+    _PARALLEL_STATE["punches"] = np.ndarray((2, n_rows), dtype=np.int64, buffer=shm.buf)
+    _PARALLEL_STATE["master"] = emp_master
+    _PARALLEL_STATE["rules"] = shift_rules
+
+def _evaluate_employee_partition(task):
+    start, end, roster_part, anomaly_part = task
+    punches = _PARALLEL_STATE["punches"]
+    df_actual = pd.DataFrame({
+        "員工": roster_part['員工'].iat[0],
+        "上班時間": punches[0, start:end].view('datetime64[ns]'),
+        "下班時間": punches[1, start:end].view('datetime64[ns]')
+    }, columns=PUNCH_COLUMNS)
+    return calculate_payroll_hours(roster_part, df_actual, anomaly_part, _PARALLEL_STATE["master"], _PARALLEL_STATE["rules"])
+
+def _parallel_mp_context():
+    # 伺服器為多執行緒行程 (session 與流程排程皆在執行緒中)，fork 會複製其他執行緒持有中的鎖；
+    # 改由單執行緒的 forkserver 產生子行程，不支援的平台 (Windows) 則用 spawn
+    if "forkserver" not in mp.get_all_start_methods():
+        return mp.get_context("spawn")
+    ctx = mp.get_context("forkserver")
+    # 重量級套件與本模組只在 forkserver 啟動時匯入一次，之後產生的子行程直接沿用
+    ctx.set_forkserver_preload(["numpy", "pandas", "streamlit", __name__])
+    return ctx
+
+def calculate_payroll_hours_parallel(df_roster, df_actual, df_anomaly, emp_master=None, workers=None, shift_rules=None):
+    """多核心模式：各員工的每日結算互不相依，依員工分區平行運算後依班表順序合併。
+
+    workers 為 1 或分區過少時，退回單一行程的 calculate_payroll_hours。
+    """
+    workers = workers or os.cpu_count() or 1
+    if emp_master is None:
+        emp_master = build_employee_master({
+            "班表": df_roster['員工'],
+            "iCHEF打卡": df_actual['員工'],
+            "異常表": df_anomaly['員工'] if not df_anomaly.empty else []
+        })
+    roster_parts = partition_by_employee(df_roster, emp_master)
+    if workers <= 1 or len(roster_parts) < 2:
+        return calculate_payroll_hours(df_roster, df_actual, df_anomaly, emp_master, shift_rules)
+    anomaly_parts = partition_by_employee(df_anomaly, emp_master)
+
+    attach_employee_ids(df_actual, emp_master, '員工')
+    punch_ids = pd.to_numeric(df_actual['員工ID'], errors='coerce').fillna(-1).to_numpy(dtype=np.int64)
+    order = np.argsort(punch_ids, kind='stable')
+    sorted_ids = punch_ids[order]
+    n_rows = len(order)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, 2 * n_rows * 8))
+    punches = None
+    try:
+        punches = np.ndarray((2, n_rows), dtype=np.int64, buffer=shm.buf)
+        punches[0] = pd.to_datetime(df_actual['上班時間']).to_numpy(dtype='datetime64[ns]').view(np.int64)[order]
+        punches[1] = pd.to_datetime(df_actual['下班時間']).to_numpy(dtype='datetime64[ns]').view(np.int64)[order]
+
+        tasks = []
+        for emp_id in sorted(roster_parts):
+            start = int(np.searchsorted(sorted_ids, emp_id, side='left'))
+            end = int(np.searchsorted(sorted_ids, emp_id, side='right'))
+            tasks.append((start, end, roster_parts[emp_id], anomaly_parts.get(emp_id, pd.DataFrame())))
+
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), mp_context=_parallel_mp_context(),
+                                 initializer=_init_parallel_worker, initargs=(shm.name, n_rows, emp_master, shift_rules)) as pool:
+            outputs = list(pool.map(_evaluate_employee_partition, tasks, chunksize=max(1, len(tasks) // (workers * 4))))
+    finally:
+        # 須先釋放陣列檢視，否則 close() 會拋出 BufferError 並蓋掉原本的例外
+        del punches
+        shm.close()
+        shm.unlink()
+
+    results = [res for res, _ in outputs if not res.empty]
+    audits = [aud for _, aud in outputs if not aud.empty]
+    df_results = order_like_roster(pd.concat(results, ignore_index=True) if results else pd.DataFrame(), df_roster, emp_master)
+    df_audit = order_like_roster(pd.concat(audits, ignore_index=True) if audits else pd.DataFrame(), df_roster, emp_master)
+    return df_results, df_audit
+
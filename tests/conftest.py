@@ -0,0 +1,44 @@
+import io
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def make_roster():
+    """班表攤平後的格式：日期優先，同日依員工順序。"""
+    def build(days, employees=("員工A",), shift="正常班", emp_type="正職"):
+        return pd.DataFrame([
+            {"日期": d, "員工": emp, "身份": emp_type, "班別字串": shift, "表定上班狀態": True}
+            for d in days for emp in employees
+        ])
+    return build
+
+
+@pytest.fixture
+def make_punches():
+    """clean_ichef_data 輸出的打卡段格式，每位員工套用同一組 (上班, 下班)。"""
+    def build(pairs, employees=("員工A",)):
+        return pd.DataFrame([
+            {"員工": emp, "上班時間": pd.Timestamp(i), "下班時間": pd.Timestamp(o)}
+            for emp in employees for i, o in pairs
+        ], columns=["員工", "上班時間", "下班時間"])
+    return build
+
+
+@pytest.fixture
+def make_ichef_export():
+    """依 (員工, [(動作, 時間), ...]) 區段組出 iCHEF 匯出檔位元組。"""
+    def build(blocks):
+        rows = []
+        for emp, events in blocks:
+            rows.append((emp, None))
+            rows += list(events)
+        buf = io.BytesIO()
+        pd.DataFrame(rows).to_excel(buf, header=False, index=False)
+        return buf.getvalue()
+    return build
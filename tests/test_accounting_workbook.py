@@ -0,0 +1,18 @@
+import io
+
+import openpyxl
+import pandas as pd
+
+import app
+
+
+def test_daily_sheet_omits_internal_employee_id():
+    records = [{"員工姓名": "員工A", "身份": "正職", "應發薪資(毛額)": 31000, "加班加給": 0,
+                "各項獎金與津貼總計": 0, "動態加項明細": {}, "動態扣項明細": {}}]
+    df_daily = pd.DataFrame([{"日期": "2025-03-01", "員工": "員工A", "員工ID": 0, "身份": "正職", "總工時(時)": 8.0}])
+    data = app.generate_accounting_excel(records, 0, df_daily)
+
+    ws = openpyxl.load_workbook(io.BytesIO(data), read_only=True)["每日出勤明細"]
+    header = next(ws.iter_rows(max_row=1, values_only=True))
+    assert "員工ID" not in header
+    assert list(header) == ["日期", "員工", "身份", "總工時(時)"]
@@ -0,0 +1,59 @@
+import os
+import time
+
+import app
+
+
+def test_new_store_keeps_spill_files_of_a_running_store(tmp_path):
+    store = app.new_artifact_store(max_bytes=0, spill_dir=str(tmp_path))
+    app.artifact_store_put(store, "k", b"x" * 1024)
+    assert store["items"]["k"]["path"]
+
+    app.new_artifact_store(spill_dir=str(tmp_path))
+    assert app.artifact_store_get(store, "k") == b"x" * 1024
+
+
+def test_new_store_removes_expired_spill_files(tmp_path):
+    stale = tmp_path / "123-old.pkl"
+    stale.write_bytes(b"")
+    expired = time.time() - app.ARTIFACT_TTL_SECONDS - 60
+    os.utime(stale, (expired, expired))
+
+    app.new_artifact_store(spill_dir=str(tmp_path))
+    assert not stale.exists()
+
+
+def test_entries_expire_after_the_ttl(tmp_path, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(app.time, "time", lambda: clock[0])
+    store = app.new_artifact_store(ttl_seconds=60, spill_dir=str(tmp_path))
+    app.artifact_store_put(store, "k", b"x" * 10)
+    clock[0] += 59
+    assert app.artifact_store_get(store, "k") == b"x" * 10
+    clock[0] += 2
+    assert app.artifact_store_get(store, "k") is None
+    assert store["bytes"] == 0
+
+
+def test_memory_overflow_spills_least_recently_used_and_reloads(tmp_path):
+    store = app.new_artifact_store(max_bytes=2500, spill_dir=str(tmp_path))
+    for key in ("a", "b", "c"):
+        app.artifact_store_put(store, key, key.encode() * 1000)
+    spilled = [k for k, e in store["items"].items() if e["path"]]
+    assert spilled == ["a"]
+    assert store["bytes"] == 2000 and store["disk_bytes"] > 0
+
+    assert app.artifact_store_get(store, "a") == b"a" * 1000
+    assert [k for k, e in store["items"].items() if e["path"]] == ["b"]
+    assert os.listdir(tmp_path) == [os.path.basename(store["items"]["b"]["path"])]
+    assert list(store["items"]) == ["b", "c", "a"]
+
+
+def test_disk_cap_drops_the_oldest_spilled_entries(tmp_path):
+    store = app.new_artifact_store(max_bytes=0, disk_max_bytes=2500, spill_dir=str(tmp_path))
+    for key in ("a", "b", "c"):
+        app.artifact_store_put(store, key, key.encode() * 1000)
+    assert list(store["items"]) == ["b", "c"]
+    assert store["disk_bytes"] <= 2500
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(e["path"]) for e in store["items"].values())
+    assert app.artifact_store_get(store, "a") is None
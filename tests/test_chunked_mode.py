@@ -0,0 +1,47 @@
+import io
+
+import pandas as pd
+
+import app
+
+
+def _session(day):
+    return [("上班", f"{day} 11:00"), ("下班", f"{day} 23:00")]
+
+
+def test_repeated_employee_blocks_match_standard_mode(make_roster, make_ichef_export):
+    data = make_ichef_export([
+        ("員工A", _session("2025-03-01")),
+        ("員工B", _session("2025-03-01") + _session("2025-03-02")),
+        ("員工A", _session("2025-03-02")),
+    ])
+    roster = make_roster(["2025-03-01", "2025-03-02"], employees=("員工A", "員工B"))
+    df_actual, _ = app.clean_ichef_data(io.BytesIO(data))
+    expected, _ = app.calculate_payroll_hours(roster.copy(), df_actual, pd.DataFrame())
+    actual, _, errors = app.calculate_payroll_hours_chunked(roster.copy(), io.BytesIO(data), pd.DataFrame())
+    pd.testing.assert_frame_equal(expected, actual)
+    assert not actual["狀態"].str.contains("無打卡紀錄").any()
+    assert errors.empty
+
+
+def test_only_roster_employees_within_the_month_are_kept_and_settled_once(monkeypatch, make_roster, make_ichef_export):
+    data = make_ichef_export([
+        ("員工A", _session("2025-02-10") + _session("2025-02-28") + _session("2025-03-01")),
+        ("員工C", _session("2025-03-01")),
+        ("員工A", _session("2025-03-31") + _session("2025-04-01") + _session("2025-04-20")),
+    ])
+    roster = make_roster(["2025-03-01", "2025-03-31"])
+    calls = []
+    settle = app.calculate_payroll_hours
+
+    def spy(roster_part, df_punch, *args):
+        calls.append(df_punch["上班時間"].tolist())
+        return settle(roster_part, df_punch, *args)
+
+    monkeypatch.setattr(app, "calculate_payroll_hours", spy)
+    actual, _, _ = app.calculate_payroll_hours_chunked(roster.copy(), io.BytesIO(data), pd.DataFrame())
+    assert calls == [[f"{d} 11:00" for d in ("2025-02-28", "2025-03-01", "2025-03-31", "2025-04-01")]]
+
+    df_actual, _ = app.clean_ichef_data(io.BytesIO(data))
+    expected, _ = settle(roster.copy(), df_actual, pd.DataFrame())
+    pd.testing.assert_frame_equal(expected, actual)
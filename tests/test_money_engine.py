@@ -0,0 +1,59 @@
+import pandas as pd
+import pytest
+
+import app
+
+
+def _payslip(emp_type, base, late_mins=0, ot_hours=0.0, total_hours=0.0, fixed_items=None, var_items=None, money_report=None):
+    df_calc = pd.DataFrame([{"日期": "2025-03-03", "員工": "員工A", "身份": emp_type, "遲到(分)": late_mins,
+                             "早退(分)": 0, "加班(時)": ot_hours, "總工時(時)": total_hours}])
+    fixed_items, var_items = fixed_items or {}, var_items or {}
+    df_fixed = pd.DataFrame([{"員工姓名": "員工A", "本薪或時薪": base, "勞保扣款": 800, "健保扣款": 500, **fixed_items}])
+    df_var = pd.DataFrame([{"員工姓名": "員工A", **var_items}])
+    records = app.generate_final_payslip(df_calc, df_fixed, df_var, list(var_items), list(fixed_items),
+                                         pd.DataFrame(), [], money_report=money_report)
+    return records[0]
+
+
+@pytest.mark.parametrize("values, expected", [
+    ([0.125], [13]), ([0.145], [15]), ([1.005], [101]), ([446.885], [44689]), ([-0.125], [-13]), ([35500], [3550000]),
+])
+def test_to_cents_rounds_half_up(values, expected):
+    assert app.to_cents(values).tolist() == expected
+
+
+def test_to_qty_units_rounds_half_up():
+    assert app.to_qty_units([0.00005, 1.5]).tolist() == [1, 15000]
+
+
+@pytest.mark.parametrize("num, den", [(-5, 2), (-3, 2), (-150, 100), (-149, 100), (-151, 100), (7, 2), (-7, 3)])
+def test_half_up_div_matches_custom_round_on_negatives(num, den):
+    assert app.half_up_div(num, den) == app.custom_round(num / den)
+
+
+def test_cents_engine_matches_float_engine_where_floats_are_exact():
+    report = []
+    record = _payslip("正職", 36000, late_mins=30, ot_hours=2.0, fixed_items={"全勤": 1000, "借支": -500.5},
+                      var_items={"業績": 250.25}, money_report=report)
+    assert report == []
+    assert record["出勤扣款"] == 75.0
+    assert record["加班加給"] == 300.0
+    # 36,000 + 300 + 1,000 + 250.25 - 75 - 500.5 - 1,300 = 35,674.75
+    assert record["本月實領薪資"] == 35675
+
+
+def test_late_deduction_on_a_35500_salary_rounds_the_half_cent_up():
+    # 35,500 / 240 / 60 * 54 = 133.125 元
+    record = _payslip("正職", 35500, late_mins=54)
+    assert record["出勤扣款"] == 133.13
+
+
+def test_payslip_items_add_up_to_the_cents_totals():
+    record = _payslip("正職", 35500, fixed_items={"伙食": 446.885, "借支": -446.885},
+                      var_items={"罰款": -0.125, "績效": 0.145})
+    assert record["動態加項明細"] == {"伙食": 446.89, "績效": 0.15}
+    assert record["動態扣項明細"] == {"借支": 446.89, "罰款": 0.13}
+    assert record["各項扣款總計"] == 447.02
+    assert record["各項獎金與津貼總計"] == round(sum(record["動態加項明細"].values()), 2)
+    net = record["應發薪資(毛額)"] - record["各項扣款總計"] + record["勞健保扣款"]
+    assert record["本月實領薪資"] == app.custom_round(round(net, 2))
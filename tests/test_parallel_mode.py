@@ -0,0 +1,51 @@
+import importlib.util
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+import app
+import payroll_engine
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+DAYS = ["2025-03-01", "2025-03-02"]
+EMPLOYEES = ("員工A", "員工B")
+PAIRS = [(f"{d} 11:00", f"{d} 23:00") for d in DAYS]
+
+
+def test_parallel_matches_single_process(make_roster, make_punches):
+    expected = app.calculate_payroll_hours(make_roster(DAYS, EMPLOYEES), make_punches(PAIRS, EMPLOYEES), pd.DataFrame())
+    actual = app.calculate_payroll_hours_parallel(make_roster(DAYS, EMPLOYEES), make_punches(PAIRS, EMPLOYEES),
+                                                  pd.DataFrame(), workers=2)
+    pd.testing.assert_frame_equal(expected[0], actual[0])
+    pd.testing.assert_frame_equal(expected[1], actual[1])
+
+
+def test_pool_failure_is_not_masked_by_shared_memory_cleanup(monkeypatch, make_roster, make_punches):
+    def broken_pool(*args, **kwargs):
+        raise RuntimeError("pool failed")
+
+    monkeypatch.setattr(payroll_engine, "ProcessPoolExecutor", broken_pool)
+    with pytest.raises(RuntimeError, match="pool failed"):
+        app.calculate_payroll_hours_parallel(make_roster(DAYS, EMPLOYEES), make_punches(PAIRS, EMPLOYEES),
+                                             pd.DataFrame(), workers=2)
+
+
+def _load_app_as_main(monkeypatch):
+    # streamlit 每次 rerun 都以新的模組物件取代 __main__ 並重新執行 app.py
+    spec = importlib.util.spec_from_file_location("__main__", APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    monkeypatch.setitem(sys.modules, "__main__", module)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_parallel_survives_a_rerun_of_another_session(monkeypatch, make_roster, make_punches):
+    first = _load_app_as_main(monkeypatch)
+    _load_app_as_main(monkeypatch)
+    expected = first.calculate_payroll_hours(make_roster(DAYS, EMPLOYEES), make_punches(PAIRS, EMPLOYEES), pd.DataFrame())
+    actual = first.calculate_payroll_hours_parallel(make_roster(DAYS, EMPLOYEES), make_punches(PAIRS, EMPLOYEES),
+                                                    pd.DataFrame(), workers=2)
+    pd.testing.assert_frame_equal(expected[0], actual[0])
@@ -0,0 +1,72 @@
+import io
+import os
+import zipfile
+
+import app
+
+RECORD = {"員工姓名": "員工A", "本月實領薪資": 35000, "動態加項明細": {"全勤": 1000.0}}
+
+
+def test_cache_key_changes_with_every_rendered_input():
+    base = app.payslip_cache_key(RECORD, "三月", "辛苦了", "font-1")
+    assert app.payslip_cache_key(dict(reversed(list(RECORD.items()))), "三月", "辛苦了", "font-1") == base
+    variants = [
+        app.payslip_cache_key(dict(RECORD, 本月實領薪資=35001), "三月", "辛苦了", "font-1"),
+        app.payslip_cache_key(dict(RECORD, 動態加項明細={"全勤": 1500.0}), "三月", "辛苦了", "font-1"),
+        app.payslip_cache_key(RECORD, "四月", "辛苦了", "font-1"),
+        app.payslip_cache_key(RECORD, "三月", "", "font-1"),
+        app.payslip_cache_key(RECORD, "三月", "辛苦了", "font-2"),
+    ]
+    assert len({base, *variants}) == len(variants) + 1
+
+
+def test_font_fingerprint_follows_the_font_file(tmp_path):
+    font = tmp_path / "font.ttf"
+    assert app.font_fingerprint(str(font)) == "default"
+    font.write_bytes(b"v1")
+    first = app.font_fingerprint(str(font))
+    font.write_bytes(b"v2-longer")
+    os.utime(font, (1, 1))
+    assert app.font_fingerprint(str(font)) != first
+
+
+def test_cache_evicts_least_recently_used_images_over_the_byte_cap():
+    cache = app.new_payslip_render_cache(max_bytes=10)
+    app.payslip_cache_put(cache, "a", b"aaaa")
+    app.payslip_cache_put(cache, "b", b"bbbb")
+    assert app.payslip_cache_get(cache, "a") == b"aaaa"
+    app.payslip_cache_put(cache, "c", b"cccc")
+    assert list(cache["items"]) == ["a", "c"]
+    assert cache["bytes"] == 8
+
+    app.payslip_cache_put(cache, "huge", b"x" * 11)
+    assert app.payslip_cache_get(cache, "huge") is None
+    assert list(cache["items"]) == ["a", "c"]
+
+
+def test_zip_reuses_previewed_payslips_and_counts_renders(monkeypatch):
+    drawn = []
+
+    def fake_image(record, month_str, custom_msg):
+        drawn.append(record["員工姓名"])
+        return f"{record['員工姓名']}-{record['本月實領薪資']}".encode()
+
+    monkeypatch.setattr(app, "create_payslip_image", fake_image)
+    payslips = [dict(RECORD, 員工姓名=name) for name in ("員工A", "員工B", "員工C")]
+    cache = app.new_payslip_render_cache()
+
+    # 預覽只繪製所選員工，產出壓縮檔時直接沿用
+    preview, hit = app.render_payslip_cached(payslips[1], "三月", "辛苦了", cache)
+    assert (preview, hit) == ("員工B-35000".encode(), False)
+    stats = {}
+    data = app.create_zip_archive_images(payslips, "三月", "辛苦了", cache, stats, workers=2)
+    assert stats == {"rendered": 2, "reused": 1}
+    assert sorted(drawn) == ["員工A", "員工B", "員工C"]
+
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.namelist() == [f"{p['員工姓名']}_三月薪資單.jpg" for p in payslips]
+        assert zf.read("員工B_三月薪資單.jpg") == preview
+
+    payslips[2] = dict(payslips[2], 本月實領薪資=36000)
+    app.create_zip_archive_images(payslips, "三月", "辛苦了", cache, stats)
+    assert stats == {"rendered": 1, "reused": 2}
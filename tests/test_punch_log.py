@@ -0,0 +1,100 @@
+import io
+
+import pandas as pd
+
+import app
+
+
+def _day(day, clock_in="11:00", clock_out="20:00"):
+    return [("上班", f"{day} {clock_in}:00"), ("下班", f"{day} {clock_out}:00")]
+
+
+def _ingest(tmp_path, data):
+    return app.ingest_ichef_export("信義店", io.BytesIO(data), str(tmp_path))
+
+
+def _assert_same_as_clean(sessions, errors, data):
+    expected_s, expected_e = app.clean_ichef_data(io.BytesIO(data))
+    actual_s = sessions.drop(columns="錨點").reset_index(drop=True)
+    actual_e = errors.drop(columns="錨點").reset_index(drop=True)
+    pd.testing.assert_frame_equal(actual_s.astype(str), expected_s.reset_index(drop=True).astype(str))
+    if expected_e.empty:
+        assert actual_e.empty
+    else:
+        pd.testing.assert_frame_equal(actual_e.astype(str), expected_e.reset_index(drop=True).astype(str))
+
+
+def test_untimed_markers_in_one_export_are_kept_apart(tmp_path, make_ichef_export):
+    data = make_ichef_export([("員工A", [
+        ("上班", "2025-03-01 11:00:00"), ("無下班記錄", None),
+        ("上班", "2025-03-02 11:00:00"), ("無下班記錄", None),
+    ] + _day("2025-03-03"))])
+    sessions, errors, stats = _ingest(tmp_path, data)
+    assert stats["重複事件"] == 0
+    assert errors["異常類型"].tolist() == ["系統標記無下班", "系統標記無下班"]
+    _assert_same_as_clean(sessions, errors, data)
+
+
+def test_overlapping_exports_merge_like_one_export(tmp_path, make_ichef_export):
+    a_days = {d: _day(d) for d in ("2025-03-01", "2025-03-02", "2025-03-03", "2025-03-04")}
+    marker = [("上班", "2025-03-02 21:00:00"), ("無下班記錄", None)]
+    first = make_ichef_export([
+        ("員工A", a_days["2025-03-01"] + a_days["2025-03-02"] + marker),
+        ("員工B", _day("2025-03-02", "17:00", "23:00")),
+    ])
+    second = make_ichef_export([
+        ("員工A", a_days["2025-03-02"] + marker + a_days["2025-03-03"] + a_days["2025-03-04"]),
+        ("員工B", _day("2025-03-02", "17:00", "23:00") + _day("2025-03-04", "17:00", "23:00")),
+    ])
+    union = make_ichef_export([
+        ("員工A", a_days["2025-03-01"] + a_days["2025-03-02"] + marker + a_days["2025-03-03"] + a_days["2025-03-04"]),
+        ("員工B", _day("2025-03-02", "17:00", "23:00") + _day("2025-03-04", "17:00", "23:00")),
+    ])
+    _ingest(tmp_path, first)
+    sessions, errors, stats = _ingest(tmp_path, second)
+    assert stats["重複事件"] == 6
+    assert stats["新事件"] == 6
+    _assert_same_as_clean(sessions, errors, union)
+
+    _, _, again = _ingest(tmp_path, second)
+    assert again["新事件"] == 0
+    assert again["版本"] == stats["版本"]
+
+
+def test_open_clock_in_closes_in_the_next_export(tmp_path, make_ichef_export):
+    first = make_ichef_export([("員工A", _day("2025-03-02") + [("上班", "2025-03-03 22:00:00")])])
+    second = make_ichef_export([("員工A", [("下班", "2025-03-04 02:00:00")] + _day("2025-03-04"))])
+    union = make_ichef_export([("員工A", _day("2025-03-02") + [("上班", "2025-03-03 22:00:00"), ("下班", "2025-03-04 02:00:00")]
+                                + _day("2025-03-04"))])
+    _ingest(tmp_path, first)
+    sessions, errors, stats = _ingest(tmp_path, second)
+    assert stats["重新清洗"]["員工A"] == pd.Timestamp("2025-03-03").date()
+    closed = pd.to_datetime(sessions["上班時間"]).eq(pd.Timestamp("2025-03-03 22:00"))
+    assert pd.to_datetime(sessions.loc[closed, "下班時間"]).tolist() == [pd.Timestamp("2025-03-04 02:00")]
+    _assert_same_as_clean(sessions, errors, union)
+
+
+def test_replay_start_backs_up_to_straddling_and_open_sessions():
+    stored = pd.DataFrame({
+        "員工": ["員工A", "員工A"],
+        "上班時間": [pd.Timestamp("2025-03-02 22:00"), pd.Timestamp("2025-03-04 11:00")],
+        "下班時間": [pd.Timestamp("2025-03-03 02:00"), pd.Timestamp("2025-03-04 20:00")],
+        "錨點": [pd.Timestamp("2025-03-02 22:00"), pd.Timestamp("2025-03-04 11:00")],
+    })
+    assert app._replay_start(stored.iloc[:0], pd.Timestamp("2025-03-04 09:00")) == pd.Timestamp("2025-03-03")
+    assert app._replay_start(stored, pd.Timestamp("2025-03-04 09:00")) == pd.Timestamp("2025-03-02 22:00")
+
+    open_last = stored.assign(下班時間=[pd.Timestamp("2025-03-03 02:00"), pd.NaT])
+    assert app._replay_start(open_last, pd.Timestamp("2025-03-10 09:00")) == pd.Timestamp("2025-03-04 11:00")
+
+
+def test_trim_keeps_one_margin_day_and_drops_the_anchor(make_roster):
+    anchors = pd.to_datetime(["2025-02-27 11:00", "2025-02-28 23:00", "2025-03-15 11:00", "2025-04-01 01:00", "2025-04-02 00:00"])
+    sessions = pd.DataFrame({"員工": "員工A", "上班時間": anchors, "下班時間": anchors, "錨點": anchors})
+    errors = pd.DataFrame({"員工": ["員工A"], "異常類型": ["系統標記無下班"], "打卡時間": ["2025-01-31 11:00:00"],
+                           "錨點": [pd.Timestamp("2025-01-31 11:00")]})
+    roster = make_roster(["2025-03-01", "2025-03-31"])
+    df_s, df_e = app.trim_punch_log_to_roster(sessions, errors, roster)
+    assert df_s["上班時間"].tolist() == list(anchors[1:4])
+    assert list(df_s.columns) == ["員工", "上班時間", "下班時間"]
+    assert df_e.empty and "錨點" not in df_e.columns
@@ -0,0 +1,25 @@
+import pandas as pd
+
+import app
+
+
+def test_out_of_month_punches_do_not_change_roster_days(make_roster, make_punches):
+    days = ["2025-03-01", "2025-03-02", "2025-03-03"]
+    in_month = [
+        ("2025-03-01 11:00", "2025-03-01 14:30"), ("2025-03-01 17:00", "2025-03-01 23:00"),
+        ("2025-03-02 11:05", "2025-03-02 23:00"),
+    ]
+    outside = [
+        ("2025-02-27 11:00", "2025-02-27 23:00"), ("2025-02-28 17:00", "2025-02-28 23:00"),
+        ("2025-03-04 11:00", "2025-03-04 23:00"),
+    ]
+    expected, _ = app.calculate_payroll_hours(make_roster(days), make_punches(in_month), pd.DataFrame())
+    actual, _ = app.calculate_payroll_hours(make_roster(days), make_punches(in_month + outside), pd.DataFrame())
+    pd.testing.assert_frame_equal(expected, actual)
+    assert actual.loc[actual["日期"] == "2025-03-03", "狀態"].tolist() == ["無打卡紀錄(曠職或未核)"]
+
+
+def test_overnight_punches_still_join_the_last_roster_day(make_roster, make_punches):
+    shifts = make_roster(["2025-03-03"], shift="1800-0200")
+    actual, _ = app.calculate_payroll_hours(shifts, make_punches([("2025-03-03 18:00", "2025-03-04 02:00")]), pd.DataFrame())
+    assert actual["總工時(時)"].tolist() == [8.0]
@@ -0,0 +1,108 @@
+import copy
+import io
+import json
+
+import pandas as pd
+import pytest
+
+import app
+import payroll_engine
+
+DAY = "2025-03-03"
+
+# 預設規則須重現規則檔導入前引擎的結果 (遲到, 早退, 加班, 總工時, 狀態)
+BASELINE = [
+    ("正職", "正常班", ["10:55", "14:35", "16:58", "23:05"], (0, 0, 1.0, 9.5, "正常結算")),
+    ("正職", "正常班", ["11:20", "14:30", "17:00", "22:40"], (20, 0, 0.5, 9.17, "正常結算")),
+    ("正職", "正常班", ["15:10", "23:00"], (10, 0, 0.0, 7.83, "正常結算")),
+    ("正職", "正常班", ["15:40", "22:20"], (40, 40, 0.0, 6.67, "正常結算")),
+    ("PT", "1100-2200", ["10:50", "15:20", "17:05", "22:10"], (0, 0, 0.0, 9.0, "PT時數結算")),
+    ("PT", "1400-2100", ["13:50", "21:05"], (0, 0, 0.0, 7.0, "PT時數結算")),
+    ("正職", "1200-2000", ["12:10", "19:50"], (10, 0, 0.0, 7.67, "正常結算")),
+    ("正職", "1800-0200", ["17:55", "26:30"], (0, 0, 0.0, 8.0, "正常結算")),
+]
+
+
+def _punches(times):
+    stamps = [pd.Timestamp(DAY) + pd.Timedelta(hours=int(t[:2]), minutes=int(t[3:])) for t in times]
+    return pd.DataFrame([{"員工": "員工A", "上班時間": stamps[i], "下班時間": stamps[i + 1]} for i in range(0, len(stamps), 2)])
+
+
+def _settle(make_roster, emp_type, shift, times, shift_rules=None):
+    roster = make_roster([DAY], shift=shift, emp_type=emp_type)
+    res, _ = app.calculate_payroll_hours(roster, _punches(times), pd.DataFrame(), shift_rules=shift_rules)
+    row = res.iloc[0]
+    return (row["遲到(分)"], row["早退(分)"], row["加班(時)"], row["總工時(時)"], row["狀態"])
+
+
+@pytest.mark.parametrize("emp_type, shift, times, expected", BASELINE)
+def test_default_rules_reproduce_the_baseline(make_roster, emp_type, shift, times, expected):
+    assert _settle(make_roster, emp_type, shift, times) == expected
+
+
+def test_compile_merges_store_shifts_over_the_defaults():
+    before = copy.deepcopy(payroll_engine.DEFAULT_SHIFT_RULES)
+    rules = payroll_engine.compile_shift_rules({
+        "寬限分鐘": 10,
+        "正職班別": {"大夜班": {"時段": [["22:00", "06:00"]], "基本時數": 8}},
+    })
+    assert payroll_engine.DEFAULT_SHIFT_RULES == before
+    assert set(rules["full"]) == {"正常班", "大夜班"}
+    night = rules["full"]["大夜班"]
+    assert night["window"] == (pd.Timedelta(hours=22), pd.Timedelta(hours=30))
+    assert night["grace"] == pd.Timedelta(minutes=10)
+    assert rules["full"]["正常班"]["alt"]["base_hours"] == 8.0
+
+
+@pytest.mark.parametrize("spec, message", [
+    ({"時段": []}, "未定義時段"),
+    ({"時段": [["11:00", "14:00"], ["17:00", "22:00"]]}, "分段點"),
+    ({"時段": [["11:00", "25:00"]]}, "時間格式錯誤"),
+    ({"時段": [["11:60", "14:00"]]}, "時間格式錯誤"),
+])
+def test_compile_rejects_malformed_shifts(spec, message):
+    with pytest.raises(ValueError, match=message):
+        payroll_engine.compile_shift_rules({"正職班別": {"早班": spec}})
+
+
+@pytest.mark.parametrize("payload, message", [
+    (b"{not json", "班別規則檔解析失敗"),
+    (b"[]", "最外層需為物件"),
+    (json.dumps({"PT班別": {"晚班": {"時段": [["24:00", "02:00"]]}}}).encode(), "時間格式錯誤"),
+    (json.dumps({"寬限分鐘": "三十"}).encode(), "班別規則檔解析失敗"),
+])
+def test_load_reports_errors_instead_of_raising(payload, message):
+    rules, error = payroll_engine.load_shift_rules(io.BytesIO(payload))
+    assert rules is None
+    assert message in error
+
+
+def test_custom_rules_file_drives_the_settlement(make_roster):
+    payload = {"正職班別": {"早班": {"時段": [["07:00", "15:00"]], "基本時數": 8}}}
+    rules, error = payroll_engine.load_shift_rules(io.BytesIO(json.dumps(payload).encode()))
+    assert error == ""
+    assert _settle(make_roster, "正職", "早班", ["07:10", "15:00"], rules) == (10, 0, 0.0, 7.83, "正常結算")
+    # 未載入規則檔時「早班」不在查表中，退回正常班時段判定
+    assert _settle(make_roster, "正職", "早班", ["07:10", "15:00"]) != (10, 0, 0.0, 7.83, "正常結算")
+
+
+def test_ad_hoc_ranges_are_not_cached_into_the_shared_rules(make_roster):
+    _settle(make_roster, "正職", "1300-2100", ["13:00", "21:00"])
+    assert "1300-2100" not in payroll_engine.DEFAULT_COMPILED_SHIFT_RULES["full"]
+
+
+def test_roster_cells_naming_a_rule_shift_keep_that_name():
+    sheet = pd.DataFrame([
+        ["職別", "正職", "PT"],
+        ["姓名", "員工A", "員工B"],
+        ["2025-03-03", "早班", "早班"],
+        ["2025-03-04", "1100-2000", ""],
+    ])
+    buf = io.BytesIO()
+    sheet.to_excel(buf, sheet_name="三月", header=False, index=False)
+    rules = payroll_engine.compile_shift_rules({"正職班別": {"早班": {"時段": [["07:00", "15:00"]]}}})
+
+    roster, _ = app.parse_roster_data(io.BytesIO(buf.getvalue()), "三月", rules)
+    assert roster["班別字串"].tolist() == ["早班", "正常班", "1100-2000", ""]
+    default, _ = app.parse_roster_data(io.BytesIO(buf.getvalue()), "三月")
+    assert default["班別字串"].tolist() == ["正常班", "正常班", "1100-2000", ""]
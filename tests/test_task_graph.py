@@ -0,0 +1,58 @@
+import threading
+import time
+
+import pytest
+
+import app
+
+
+def _sleeping(seconds, value):
+    def step(*_):
+        time.sleep(seconds)
+        return value
+    return step
+
+
+def test_steps_receive_dependency_results_and_report_the_critical_path():
+    steps = {
+        "班表": (_sleeping(0.02, 2), []),
+        "打卡": (_sleeping(0.15, 3), []),
+        "結算": (lambda roster, punches: roster * punches, ["班表", "打卡"]),
+        "報表": (lambda total: f"合計 {total}", ["結算"]),
+    }
+    results, summary = app.run_task_graph(steps)
+    assert results == {"班表": 2, "打卡": 3, "結算": 6, "報表": "合計 6"}
+    assert summary["critical_path"] == ["打卡", "結算", "報表"]
+    rows = summary["steps"].set_index("步驟")
+    assert rows.loc["結算", "關鍵路徑"] == "打卡 → 結算"
+    # 兩個無相依步驟同時執行，總耗時不是兩者相加
+    assert summary["wall_seconds"] < 0.15 + 0.02 + 0.1
+    assert rows.loc["班表", "開始(秒)"] < 0.05 and rows.loc["打卡", "開始(秒)"] < 0.05
+
+
+def test_a_failing_step_stops_dependents_and_raises_the_original_error():
+    started, finished = [], threading.Event()
+
+    def bad_roster():
+        raise app.StageInputError("找不到「姓名」標籤")
+
+    def slow_punches():
+        time.sleep(0.05)
+        finished.set()
+
+    steps = {
+        "班表": (bad_roster, []),
+        "打卡": (slow_punches, []),
+        "結算": (lambda *_: started.append("結算"), ["班表", "打卡"]),
+    }
+    with pytest.raises(app.StageInputError, match="姓名"):
+        app.run_task_graph(steps)
+    assert finished.is_set()
+    assert started == []
+
+
+def test_cycles_and_unknown_dependencies_are_rejected():
+    with pytest.raises(ValueError, match="成環"):
+        app.run_task_graph({"a": (lambda: 1, []), "b": (lambda *_: 2, ["a", "c"]), "c": (lambda *_: 3, ["b"])})
+    with pytest.raises(ValueError, match="未定義的相依步驟：d"):
+        app.run_task_graph({"a": (lambda *_: 1, ["d"])})